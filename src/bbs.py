@@ -2,62 +2,130 @@
 # Blum Blum Shub CSPRNG
 #
 
+import os
 import random
-from sympy.ntheory.factor_ import totient # Used for testing.
-from collections import Counter
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from utils import circular_left_shift
-from discmath import randprime, nextprime
+from discmath import randprime, next_blum_prime
 
 def get_prime(seed):
     """
     Return a large prime which is not a factor in seed.
     """
-    p = nextprime(seed)
-    while (((p % 4) != 3) or ((seed % p) == 0)):
-        p = nextprime(p)
+    p = next_blum_prime(seed)
+    while ((seed % p) == 0):
+        p = next_blum_prime(p)
     return p
 
 def get_rand_seed():
     """
-    Generate a random seed, for testing. V is phi(N)
+    Generate a random seed, for testing. V is phi(N), p and q are distinct primes so phi(N) = (p-1)(q-1).
     """
-    p, q = get_prime(randprime(2**7, 2**10)), get_prime(randprime(2**11, 2**14))    
+    p, q = get_prime(randprime(2**7, 2**10)), get_prime(randprime(2**11, 2**14))
     N = p*q
-    V = totient(N)
+    V = (p-1)*(q-1)
     S = random.randint(1,(V-1))
     while ((S % p) == 0) or ((S % q) == 0):
         S = random.randint(1,(V-1))
     return S
 
-def test_csprng(N=1000, bits=50):
+def sample_keystream(args):
+    """
+    Generate bits of keystream for a seed, packed into bytes. Runs in the worker processes.
+    """
+    seed, bits, bits_per_step = args
+    return BlumBlumShub(seed, bits_per_step).read_bits(bits).to_bytes(((bits + 7) // 8), 'big')
+
+def test_csprng(N=1000, bits=50, workers=None, bits_per_step=1):
     """
     Simple test whether or not the algorithm is compliant to the
     CSPRNG requirements. We want 50% 0, 50% 1 in the bitstring!
     N is the amount of iterations/simulations.
     bits is how many bits to generate for each iteration, in the BBS algorithm.
+    The seeds are generated here and fanned out over worker processes, the
+    concatenated keystream then runs through the randtest battery.
+    """
+    import numpy as np
+    from randtest import run_tests
+
+    jobs = [(get_rand_seed(), bits, bits_per_step) for _ in range(N)]
+    if workers == 1 or N < 64:
+        samples = list(map(sample_keystream, jobs))
+    else:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(workers) as executor:
+            samples = list(executor.map(sample_keystream, jobs, chunksize=max(1, N // (4 * workers))))
+    pad = ((bits + 7) // 8) * 8 - bits
+    result = np.concatenate([np.unpackbits(np.frombuffer(v, dtype=np.uint8))[pad:] for v in samples])
+    ones = int(np.count_nonzero(result))
+    zeros, tot = (len(result) - ones), len(result)
+    report = ["Test Results:\n0 - {}, {:.04}\n1 - {}, {:.04}".format(zeros, (zeros/tot), ones, (ones/tot))]
+    for name, p in run_tests(np.packbits(result), tot).items():
+        report.append("{} - p={}{}".format(name, ("{:.04}".format(p) if p is not None else "n/a"), (" FAIL" if p is not None and p < 0.01 else "")))
+    return "\n".join(report)
+
+@lru_cache(maxsize=1024)
+def get_modulus(seed):
     """
-    result = []
-    for _ in range(N):
-        result.extend(list(blum_blum_shub(bits, get_rand_seed(), False)))
-    v = dict(Counter(result))
-    tot = v['0'] + v['1']
-    return "Test Results:\n0 - {}, {:.04}\n1 - {}, {:.04}".format(v['0'], (v['0']/tot), v['1'], (v['1']/tot))
+    N = p*q for seed, p and q are large primes, and not factors of the seed.
+    """
+    return get_prime(seed) * get_prime(circular_left_shift(seed, 2, 64))
+
+class BlumBlumShub:
+    """
+    Stateful BBS keystream generator, the modulus is computed once.
+    Each squaring yields the log2(log2(N)) lowest bits of X, or bits_per_step if lower.
+    """
+    READ_CHUNK = 512 # Bits gathered per big integer, keeps the bit packing linear.
+
+    def __init__(self, seed, bits_per_step=None):
+        self.N = get_modulus(seed)
+        self.X = ((seed**2) % self.N)
+        safe_bits = max(1, self.N.bit_length().bit_length() - 1)
+        self.bits_per_step = min(bits_per_step or safe_bits, safe_bits)
+        self.mask = ((1 << self.bits_per_step) - 1)
+        self.pending = 0 # Extracted bits not yet returned.
+        self.pending_bits = 0
+
+    def read_bits(self, n):
+        """
+        Return the next n bits as an integer, the first bit is the most significant.
+        """
+        X, N, k, mask = self.X, self.N, self.bits_per_step, self.mask
+        acc, acc_bits = self.pending, self.pending_bits
+        while acc_bits < n:
+            X = (X * X) % N
+            acc = ((acc << k) | (X & mask))
+            acc_bits += k
+        self.X = X
+        self.pending_bits = (acc_bits - n)
+        self.pending = (acc & ((1 << self.pending_bits) - 1))
+        return (acc >> self.pending_bits)
+
+    def read(self, n):
+        """
+        Return the next n bytes of keystream.
+        """
+        out = bytearray()
+        chunk = (self.READ_CHUNK // 8)
+        while len(out) < n:
+            size = min(chunk, n - len(out))
+            out += self.read_bits(size * 8).to_bytes(size, 'big')
+        return bytes(out)
+
+    def __iter__(self):
+        while True:
+            yield self.read(self.READ_CHUNK // 8)
 
 def blum_blum_shub(num_bits, seed, return_as_dec=True):
     """
     Generate bitstring, given seed. Using the BBS algorithm.
     p and q are large primes, and not factors of the seed.
+    Only the parity bit of each squaring is used, so derived keys stay the same.
     """
-    p, q = get_prime(seed), get_prime(circular_left_shift(seed, 2, 64))
-    N = p*q
-    bitstring = []
-    X = ((seed**2) % N)
-    for _ in range(num_bits):
-        X = (X**2) % N
-        B = (X % 2)
-        bitstring.append(str(B))
-    output = "".join(bitstring)
-    return (int(output, 2) if return_as_dec else output)
+    value = BlumBlumShub(seed, 1).read_bits(num_bits)
+    return (value if return_as_dec else format(value, '0{}b'.format(num_bits)))
 
 if __name__ == "__main__":
     print("Testing Blum Blum Shub randomness\n")
@@ -0,0 +1,172 @@
+#
+# Microbenchmarks for the crypto and number theory primitives
+#
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+import subprocess
+from collections import namedtuple
+from sdes import encrypt_sdes, decrypt_sdes, encrypt_bytes, get_tables, encrypt_ctr
+from bbs import blum_blum_shub, BlumBlumShub
+from dh import generate_dh_parameters, get_private_key, get_public_key
+from discmath import sieve, primitive_root, is_prime, random_prime
+from ciphers import SUITES
+
+MIN_TIME = 0.05 # Seconds per repeat, the number of calls is scaled up to reach it.
+WARMUP = 1
+REPEATS = 7
+THRESHOLD = 0.10 # Slowdown of the median that counts as a regression.
+
+Benchmark = namedtuple('Benchmark', ['name', 'func', 'unit', 'units', 'timed'])
+
+def import_time(module):
+    """
+    Seconds to import module in a fresh interpreter, measured inside it.
+    """
+    code = "import time; t = time.perf_counter(); import {}; print(time.perf_counter() - t)".format(module)
+    out = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, check=True)
+    return float(out.stdout)
+
+def benchmarks():
+    """
+    Every benchmark, func is called without arguments. units is the amount of unit handled per call,
+    timed benchmarks return their own duration.
+    """
+    text = {n: "".join(chr(random.randint(32, 126)) for _ in range(n)) for n in (64, 1024)}
+    data = {n: os.urandom(n) for n in (1024, 1 << 16, 1 << 20)}
+    ciphertext = {n: encrypt_sdes(text[n], 0b1010000010) for n in text}
+    q, a = 49919, 7
+    groups = {16: (q, a), 64: generate_dh_parameters(64), 256: generate_dh_parameters(256)} # Larger groups are where the key pair pool pays off.
+    marks = []
+    for n in text:
+        marks.append(Benchmark("sdes.encrypt_sdes/{}".format(n), lambda n=n: encrypt_sdes(text[n], 0b1010000010), 'KB', n / 1024, False))
+        marks.append(Benchmark("sdes.decrypt_sdes/{}".format(n), lambda n=n: decrypt_sdes(ciphertext[n], 0b1010000010), 'KB', n / 1024, False))
+    for n in data:
+        marks.append(Benchmark("sdes.encrypt_bytes/{}".format(n), lambda n=n: encrypt_bytes(data[n], 0b1010000010), 'KB', n / 1024, False))
+        marks.append(Benchmark("sdes.encrypt_ctr/{}".format(n), lambda n=n: encrypt_ctr(data[n], 0b1010000010, workers=1), 'KB', n / 1024, False))
+    marks.append(Benchmark("sdes.get_tables", lambda: (get_tables.cache_clear(), get_tables(0b1010000010)), 'call', 1, False))
+    for suite in SUITES.values(): # Only the suites which can run here, compare them per message size.
+        key = suite.derive(random_prime(32))
+        for n in (64, 1024, 1 << 16, 1 << 20):
+            payload = data.get(n) or os.urandom(n)
+            sealed, out = suite.encrypt(key, payload), bytearray(n + suite.overhead + suite.block_size)
+            marks.append(Benchmark("ciphers.{}.encrypt/{}".format(suite.name, n), lambda suite=suite, key=key, payload=payload: suite.encrypt(key, payload), 'KB', n / 1024, False))
+            marks.append(Benchmark("ciphers.{}.encrypt_into/{}".format(suite.name, n), lambda suite=suite, key=key, payload=payload, out=out: suite.encrypt_into(key, payload, out), 'KB', n / 1024, False))
+            marks.append(Benchmark("ciphers.{}.decrypt/{}".format(suite.name, n), lambda suite=suite, key=key, sealed=sealed: suite.decrypt(key, sealed), 'KB', n / 1024, False))
+        marks.append(Benchmark("ciphers.{}.derive".format(suite.name), lambda suite=suite: suite.derive(random.getrandbits(32) | 1), 'call', 1, False))
+    for n in (10, 100, 1000):
+        marks.append(Benchmark("bbs.blum_blum_shub/{}".format(n), lambda n=n: blum_blum_shub(n, random.randint(2**11, 2**16)), 'bit', n, False))
+    marks.append(Benchmark("bbs.BlumBlumShub.read/4096", lambda: BlumBlumShub(random.randint(2**11, 2**16)).read(4096), 'KB', 4, False))
+    marks.append(Benchmark("dh.generate_dh_parameters", lambda: generate_dh_parameters(), 'call', 1, False))
+    for bits in (32, 64):
+        marks.append(Benchmark("dh.generate_dh_parameters/{}".format(bits), lambda bits=bits: generate_dh_parameters(bits), 'call', 1, False))
+    marks.append(Benchmark("dh.generate_dh_parameters/safe32", lambda: generate_dh_parameters(32, True), 'call', 1, False))
+    for bits, (p, g) in groups.items():
+        private = get_private_key(p)
+        marks.append(Benchmark("dh.get_private_key/{}".format(bits), lambda p=p: get_private_key(p), 'call', 1, False))
+        marks.append(Benchmark("dh.get_public_key/{}".format(bits), lambda p=p, g=g, private=private: get_public_key(private, p, g), 'call', 1, False))
+    marks.append(Benchmark("discmath.primitive_root/16", lambda: primitive_root(q), 'call', 1, False))
+    big = random_prime(64)
+    marks.append(Benchmark("discmath.primitive_root/64", lambda: primitive_root(big), 'call', 1, False))
+    marks.append(Benchmark("discmath.is_prime/64", lambda: is_prime(random.getrandbits(64) | 1), 'call', 1, False))
+    for n in (2**17, 2**20, 2**24):
+        marks.append(Benchmark("discmath.sieve/{}".format(n), lambda n=n: sieve(n), 'call', 1, False))
+    for module in ('sdes', 'bbs', 'dh', 'discmath', 'ciphers'):
+        marks.append(Benchmark("import.{}".format(module), lambda module=module: import_time(module), 'call', 1, True))
+    return marks
+
+def measure(bench, min_time=MIN_TIME, warmup=WARMUP, repeats=REPEATS):
+    """
+    Seconds per call for every repeat, after warmup calls.
+    Fast functions run in a loop sized to take about min_time per repeat.
+    """
+    random.seed(0) # Same inputs on every run.
+    if bench.timed:
+        for _ in range(warmup):
+            bench.func()
+        return [bench.func() for _ in range(repeats)]
+    for _ in range(warmup):
+        bench.func()
+    number, elapsed = 1, 0
+    while True: # Calibrate.
+        start = time.perf_counter()
+        for _ in range(number):
+            bench.func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= (1 << 20):
+            break
+        number *= max(2, min(10, int(min_time / max(elapsed, 1e-9))))
+    times = [elapsed / number]
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            bench.func()
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+def summarize(bench, times):
+    median = statistics.median(times)
+    return {
+        'median': median,
+        'mean': statistics.mean(times),
+        'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'min': min(times),
+        'max': max(times),
+        'repeats': len(times),
+        'unit': bench.unit,
+        'per_unit': median / bench.units,
+    }
+
+def format_time(seconds):
+    for scale, suffix in ((1, 's'), (1e-3, 'ms'), (1e-6, 'us')):
+        if seconds >= scale:
+            return "{:.3f} {}".format(seconds / scale, suffix)
+    return "{:.1f} ns".format(seconds * 1e9)
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Names of the benchmarks whose median is slower than the baseline by more than threshold.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name in baseline and result['median'] > baseline[name]['median'] * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Microbenchmarks for sdes, bbs, dh and discmath')
+    parser.add_argument('-k', '--filter', default=None, help='Only run benchmarks containing this text.')
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--warmup', type=int, default=WARMUP)
+    parser.add_argument('--min-time', type=float, default=MIN_TIME, help='Seconds per repeat.')
+    parser.add_argument('--save', default=None, help='Write the results to this JSON file, to use as a baseline.')
+    parser.add_argument('--baseline', default=None, help='Compare with a saved run, exit 1 on regressions.')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='Allowed slowdown of the median, 0.1 is 10%%.')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+    results = {}
+    for bench in benchmarks():
+        if args.filter and args.filter not in bench.name:
+            continue
+        results[bench.name] = result = summarize(bench, measure(bench, args.min_time, args.warmup, args.repeats))
+        line = "{:<36} {:>12} +- {:<10} {:>12}/{}".format(bench.name, format_time(result['median']), format_time(result['stdev']), format_time(result['per_unit']), result['unit'])
+        if bench.name in baseline:
+            line += "  {:+.1f}%".format(100 * (result['median'] / baseline[bench.name]['median'] - 1))
+        print(line, flush=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0], 'results': results}, f, indent=1)
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print("\nRegressions over {:.0f}%: {}".format(100 * args.threshold, ", ".join(regressions)))
+        sys.exit(1)
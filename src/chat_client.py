@@ -2,85 +2,50 @@
 # Secure Chat Client
 #
 
+import os
 import sys
-import time
 import signal
-import socket
-from threading import Thread
-from bbs import blum_blum_shub, test_csprng
-from dh import generate_dh_parameters, get_private_key, get_public_key, get_shared_key
-from sdes import encrypt_sdes, decrypt_sdes
+from threading import Event as ThreadEvent
+from ciphers import SUITES
+from client import SecureChatClient, EVENT_JOIN, EVENT_LEAVE, EVENT_MESSAGE, EVENT_CLOSED, EVENT_ROOM_JOIN, EVENT_ROOM_LEAVE, EVENT_ROOM_MESSAGE, EVENT_FILE_OFFER
 
-COMMAND_CONNECT = 1
-COMMAND_DISCONNECT = 2
-COMMAND_MESSAGE = 3
-BUFFER = 2048
-
-SOCKET = None
-THREAD_RECEIVE = None
-THREAD_QUIT = False
-KEYS = {}
-PARAMS = None
-PUBLIC_KEY = None
-PRIVATE_KEY = None
+CLIENT = None
+THREAD_QUIT = ThreadEvent()
+DOWNLOADS = os.environ.get('SECURECHAT_DOWNLOADS', '.') # Where received files are stored.
 
 def terminate():
-    global SOCKET, THREAD_RECEIVE, THREAD_QUIT
-    if SOCKET:
-        SOCKET.close()
-    SOCKET = None
-    THREAD_QUIT = True
-    if THREAD_RECEIVE:
-        THREAD_RECEIVE.join()
-    THREAD_RECEIVE = None
+    global CLIENT
+    if CLIENT:
+        CLIENT.close()
+    CLIENT = None
 
 def signal_handler(sig, frame):
     terminate()
     sys.exit(0)
 
-def receive():
+def on_event(event):
     """
-    Receive data from the server.
+    Called from the receive loop of the client.
     """
-    global SOCKET
-    try:
-        return SOCKET.recv(BUFFER).decode('ascii').split(',')
-    except:
-        return None
-
-def receive_async():
-    time.sleep(0.1)
-    global THREAD_QUIT, SOCKET, KEYS, PARAMS
-    while not THREAD_QUIT and SOCKET:
-        msg = receive()
-        if not msg:
-            continue        
-        try:
-            cmd, user = int(msg[0]), str(msg[1]).lower()
-            if cmd == COMMAND_DISCONNECT: # A user disconnected, remove from our list.
-                if user in KEYS:
-                    del KEYS[user]
-                print("{} left the chat.".format(user.capitalize()))
-            elif cmd == COMMAND_CONNECT: # A user connected, store the public key and nickname for this user.
-                for clients in msg[1:]:
-                    user, key = clients.split(':')[0].lower(), clients.split(':')[1]
-                    KEYS[user] = int(key)
-                    print("{} joined the chat.".format(user.capitalize()))
-            elif cmd == COMMAND_MESSAGE: # Read message from user, decrypt with shared key. Given that you know the users public key.
-                if user in KEYS:
-                    q, a = PARAMS
-                    shared = get_shared_key(KEYS[user], PRIVATE_KEY, q)
-                    secret = blum_blum_shub(10, shared) # Secret key!
-                    print("From {} (PUab {}, Kab {}, Secret {}): {}".format(user.capitalize(), KEYS[user], shared, secret, decrypt_sdes(msg[2], secret)))
-        except Exception as e:
-            print(e)
-            THREAD_QUIT = True
+    if event.type == EVENT_LEAVE:
+        print("{} left the chat.".format(event.nick.capitalize()))
+    elif event.type == EVENT_JOIN:
+        print("{} joined the chat.".format(event.nick.capitalize()))
+    elif event.type == EVENT_MESSAGE:
+        key, shared, secret, tables = CLIENT.get_session_key(event.nick)
+        print("From {} (PUab {}, Kab {}, Secret {}, {}): {}".format(event.nick.capitalize(), key, shared, secret, SUITES[event.suite].name, event.data))
+    elif event.type == EVENT_ROOM_JOIN:
+        print("{} joined {}.".format(event.nick.capitalize(), event.room))
+    elif event.type == EVENT_ROOM_LEAVE:
+        print("{} left {}.".format(event.nick.capitalize(), event.room))
+    elif event.type == EVENT_ROOM_MESSAGE:
+        print("From {} in {}: {}".format(event.nick.capitalize(), event.room, event.data))
+    elif event.type == EVENT_FILE_OFFER:
+        print("{} wants to send you {}, {} bytes. Write /accept {} or /reject {}.".format(event.nick.capitalize(), event.data[1], event.data[2], event.nick, event.nick))
+    elif event.type == EVENT_CLOSED:
+        THREAD_QUIT.set() # Connection closed.
 
 if __name__ == "__main__":    
-    SOCKET = None
-    THREAD_RECEIVE = None
-    THREAD_QUIT = False
-    KEYS = {}
     PORT = int(sys.argv[1] if len(sys.argv) > 1 else 5000)
     signal.signal(signal.SIGINT, signal_handler)
     print("Started Secure Chat Client")
@@ -89,29 +54,65 @@ if __name__ == "__main__":
     while (not NICK or len(NICK) == 0):
         NICK = input("Enter your nickname: ").replace('\n', '').strip()
 
-    q, a = 0, 0 # Diffie-Hellman params recv. from server.
     try:
         print("Connecting to localhost:{}".format(PORT))
-        SOCKET = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        SOCKET.connect(('localhost', PORT))
-        msg = receive() # Retrieve DH parameters from server.
-        PARAMS = (int(msg[0]), int(msg[1]))
-        q, a = PARAMS
-        
-        PRIVATE_KEY = get_private_key(q)
-        PUBLIC_KEY = get_public_key(PRIVATE_KEY, q, a)
-        print("Your public key is,", PUBLIC_KEY, "and your private key is,", PRIVATE_KEY)
-        SOCKET.sendall("{},{}".format(NICK, str(PUBLIC_KEY)).encode('ascii'))
+        CLIENT = SecureChatClient(NICK, 'localhost', PORT, on_event, DOWNLOADS)
+        CLIENT.connect()
+        print("Your public key is,", CLIENT.public_key, "and your private key is,", CLIENT.private_key)
+        print("Cipher suites:", ", ".join(SUITES[v].name for v in CLIENT.suites))
 
-        THREAD_RECEIVE = Thread(target = receive_async)
-        THREAD_RECEIVE.start()
-
-        print("Welcome! Write exit to exit, to message someone, write <nickname> <message>\n")
-        while not THREAD_QUIT:
+        print("Welcome! Write exit to exit, to message someone, write <nickname> <message>, to send a file, write /send <nickname> <path>")
+        print("Received files go to {}, write /accept <nickname> or /reject <nickname> to answer a file offer".format(os.path.abspath(DOWNLOADS)))
+        print("To join a room, write /join #<room>, to leave it, /leave #<room>, to message everyone in it, #<room> <message>\n")
+        while not THREAD_QUIT.is_set():
             txt = input("").replace('\n', '').strip()
             if txt.lower() == "exit":
                 break
 
+            if txt.startswith("/send "):
+                cmd = txt.split(None, 2)
+                if len(cmd) < 3 or cmd[1].lower() not in CLIENT.keys:
+                    print("Bad command format or unknown user, try /send <nick> <path>!")
+                    continue
+                try:
+                    CLIENT.send_file(cmd[1], cmd[2])
+                except OSError as e:
+                    print(e)
+                continue
+
+            if txt.startswith("/accept ") or txt.startswith("/reject "):
+                cmd = txt.split()
+                offers = [transfer_id for nick, transfer_id in list(CLIENT.offers) if len(cmd) == 2 and nick == cmd[1].lower()]
+                if not offers:
+                    print("No file offer from that user, try /accept <nick> or /reject <nick>!")
+                for transfer_id in offers:
+                    if cmd[0] == "/reject":
+                        CLIENT.reject_file(cmd[1], transfer_id)
+                        continue
+                    transfer = CLIENT.accept_file(cmd[1], transfer_id)
+                    if transfer is not None and transfer.done:
+                        print("Received {}, an empty file.".format(transfer.path))
+                continue
+
+            if txt.startswith("/join ") or txt.startswith("/leave "):
+                cmd = txt.split()
+                if len(cmd) != 2 or not cmd[1].startswith('#'):
+                    print("Bad command format, try /join #<room> or /leave #<room>!")
+                elif cmd[0] == "/join":
+                    CLIENT.join_room(cmd[1].lower())
+                else:
+                    CLIENT.leave_room(cmd[1].lower())
+                continue
+
+            if txt.startswith('#') and ' ' in txt:
+                room, msg = txt.split(None, 1)
+                try:
+                    CLIENT.send_room_message(room.lower(), msg)
+                    print("To {}: {}".format(room.lower(), msg))
+                except KeyError as e:
+                    print(e)
+                continue
+
             if len(txt) == 0 or not ' ' in txt:
                 print("Bad message format, try <nick> <message>!")
                 continue
@@ -122,13 +123,16 @@ if __name__ == "__main__":
                 continue
             
             send_to_user = str(msg[0].lower())
-            msg = " ".join(msg[1:]).replace(',', '')
+            msg = " ".join(msg[1:])
 
-            if send_to_user in KEYS:                
-                shared = get_shared_key(KEYS[send_to_user], PRIVATE_KEY, q)
-                secret = blum_blum_shub(10, shared) # Secret key!
-                SOCKET.sendall("{},{}".format(send_to_user, encrypt_sdes(msg, secret)).encode('ascii'))
-                print("To {} (PUab {}, Kab {}, Secret {}): {}".format(send_to_user.capitalize(), KEYS[send_to_user], shared, secret, msg))
+            if send_to_user in CLIENT.keys:
+                try:
+                    CLIENT.send_message(send_to_user, msg)
+                except KeyError as e:
+                    print(e)
+                    continue
+                key, shared, secret, tables = CLIENT.get_session_key(send_to_user)
+                print("To {} (PUab {}, Kab {}, Secret {}, {}): {}".format(send_to_user.capitalize(), key, shared, secret, CLIENT.get_cipher(send_to_user)[0].name, msg))
     except Exception as e:
         print(e)
     finally:
@@ -2,106 +2,697 @@
 # Secure Chat Server
 #
 
+import os
 import sys
 import signal
+import argparse
 import time
-import select
+import hmac
+import heapq
 import socket
-from sdes import encrypt_sdes, decrypt_sdes
-from bbs import blum_blum_shub, test_csprng
-from dh import generate_dh_parameters, get_private_key, get_public_key, get_shared_key
-from utils import get_as_text
+import selectors
+from itertools import islice
+from types import SimpleNamespace
+from dh import get_dh_parameters, get_private_key, get_public_key, get_shared_key, dh_bits, DH_POOL, DH_MIN_BITS, DH_SAFE_ABOVE
+from utils import get_bytes_as_bits
+from session import Session, Registry, Room, STATE_HANDSHAKE, STATE_PEER
+from protocol import encode, parse_suites, format_suites, cipher_id, CIPHER_NAMES, CIPHER_PREFERENCE
+from protocol import ProtocolError, ROUTED, CONTROL, RESUME, COMMAND_MESSAGE, COMMAND_PARAMS, COMMAND_HELLO, COMMAND_TICKET, COMMAND_RESUME, COMMAND_LEAVE, COMMAND_REJECT
+from protocol import COMMAND_BUS_JOIN, COMMAND_BUS_LEAVE, ROOM_COMMANDS, COMMAND_ROOM_JOIN, COMMAND_ROOM_LEAVE, COMMAND_ROOM_MEMBERS, COMMAND_ROOM_MESSAGE
+from metrics import Metrics, AdminServer
+from roster import Roster
+from tickets import get_ticket_secret, issue_ticket, verify_ticket, resume_proof, TICKET_TTL, DIGEST_SIZE
 
-COMMAND_CONNECT = 1
-COMMAND_DISCONNECT = 2
-COMMAND_MESSAGE = 3
-BUFFER = 2048
+DEBUG = False # Log ciphertext as a bitstring.
+HANDSHAKE_TIMEOUT = 10.0 # Seconds a new client has to send its nick and public key.
+HIGH_WATER = 256 * 1024 # Max bytes queued for a client before the slow consumer policy kicks in.
+SLOW_CONSUMER_POLICY = 'drop' # drop: discard new data, disconnect: close the client, coalesce: merge the backlog and allow up to COALESCE_LIMIT.
+COALESCE_LIMIT = 4 # Multiple of HIGH_WATER.
+POLICIES = ('drop', 'disconnect', 'coalesce')
+IOV_MAX = 512 # Max buffers written per sendmsg call.
+RESUME_GRACE = 10.0 # Seconds the nick of a dropped client is held for it to resume, peers see no leave meanwhile.
 
 SOCKET = None
-CONNECTIONS = None
+SELECTOR = None
+REGISTRY = None # Active sessions, indexed by fd and by nick.
+ROSTER = None # Every user on every worker, versioned, see roster.py.
+ROOMS = {} # Room name -> Room, with members on every worker.
+TICKET_SECRET = None # Shared by every worker, so a ticket can be used on any of them.
+GHOSTS = {} # Dropped users within the grace period, nick -> (deadline, public key and suites).
+GRACE = [] # Heap of (deadline, nick) for GHOSTS.
+JOINING = [] # (session, resume) of clients waiting for the roster, sent with the next batch.
+HANDSHAKES = None # Heap of (deadline, fd, session) for pending handshakes.
+PARAMS = None
+SERVER_KEY = None # Diffie-Hellman (private, public) key pair of the server, resuming clients prove their key with it.
+CIPHERS = CIPHER_PREFERENCE # Cipher suites offered to clients, most preferred first.
+WORKER_ID = 0
+PEERS = {} # Bus sessions to the other workers, by worker id.
+REMOTE = {} # Users on other workers, nick -> (peer session, public key and suites).
+WORKERS = [] # Worker pids, in the supervisor.
+METRICS = None
+STATS = None # The metrics by short name, see setup_metrics.
+ADMIN = None # HTTP admin endpoint, when an admin port is given.
+ADMIN_PORT = None # Workers listen on ADMIN_PORT + worker id.
 
 def terminate():
-    global SOCKET, CONNECTIONS
-    if CONNECTIONS:
-        for socket in CONNECTIONS:
-            socket.close()
-        CONNECTIONS.clear()
+    global SOCKET, REGISTRY
+    if REGISTRY:
+        for session in REGISTRY:
+            session.sock.close()
+        REGISTRY = None
+    if SOCKET:
+        SOCKET.close()
     SOCKET = None
 
 def signal_handler(sig, frame):
     terminate()
     sys.exit(0)
 
-def broadcast(text, excluded=None):
-    if CONNECTIONS is None:
+def send(session, data):
+    """
+    Queue data for the session, it is written once the socket is writable.
+    The buffer is not copied, broadcasts share one buffer between all recipients.
+    """
+    if session not in REGISTRY:
+        return
+    if session.out and (session.queued + len(data)) > HIGH_WATER and session.state != STATE_PEER:
+        slow_consumer(session, data)
+        return
+    if not session.out:
+        SELECTOR.modify(session.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, session)
+    session.out.append(data)
+    session.queued += len(data)
+
+def slow_consumer(session, data):
+    """
+    The client is not reading fast enough, apply the slow consumer policy to data.
+    Control frames are never dropped, they are queued up to COALESCE_LIMIT and the client is closed past it.
+    """
+    if SLOW_CONSUMER_POLICY == 'disconnect':
+        STATS.slow_disconnects.inc()
+        close(session)
+    elif SLOW_CONSUMER_POLICY == 'coalesce' and (session.queued + len(data)) <= (HIGH_WATER * COALESCE_LIMIT):
+        tail = session.out[-1]
+        if not isinstance(tail, bytearray): # Merge the backlog into one buffer, written with fewer syscalls once the client catches up.
+            tail = bytearray()
+            session.out.append(tail)
+        tail += data
+        session.queued += len(data)
+    elif data[4] in CONTROL: # Frame type, after the length. A missed roster delta leaves the client in a wrong state.
+        if (session.queued + len(data)) > (HIGH_WATER * COALESCE_LIMIT): # Room for a roster snapshot, not for a client which never reads.
+            STATS.slow_disconnects.inc()
+            close(session) # It resumes with its ticket and roster version.
+            return
+        session.out.append(data)
+        session.queued += len(data)
+    else:
+        session.dropped += 1
+        STATS.dropped.inc()
+
+def flush(session):
+    """
+    Write as much queued data as the socket accepts without blocking.
+    Pending buffers are coalesced into a single sendmsg call.
+    """
+    while session.out:
+        try:
+            sent = session.sock.sendmsg(list(islice(session.out, IOV_MAX)))
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            close(session)
+            return
+        session.queued -= sent
+        session.bytes_out += sent
+        STATS.bytes_out.inc(sent)
+        while sent:
+            head = session.out[0]
+            if len(head) > sent:
+                session.out[0] = memoryview(head)[sent:] # Partial write, wait for the next writable event.
+                return
+            sent -= len(head)
+            session.out.popleft()
+    SELECTOR.modify(session.sock, selectors.EVENT_READ, session)
+
+def broadcast(frame, excluded=()):
+    """
+    Queue an encoded frame for every registered client, the same buffer is shared.
+    """
+    if REGISTRY is None:
         return None
 
-    text = text.encode('ascii')
-    for s in CONNECTIONS:
-        if s == SOCKET or s == excluded:
+    for s in list(REGISTRY.users()):
+        if s in excluded:
+            continue
+        send(s, frame)
+
+def close(session, quiet=False, grace=True):
+    """
+    Drop the connection. If the client had joined, its nick is held for RESUME_GRACE seconds
+    before everyone else is told, quiet means the user lives on in another connection.
+    Without grace the user quit, everyone is told at once.
+    """
+    if session not in REGISTRY:
+        return
+    SELECTOR.unregister(session.sock)
+    session.sock.close()
+    STATS.disconnects.inc()
+    if REGISTRY.remove(session):
+        for name in list(session.rooms):
+            leave_room(ROOMS[name], session.nick)
+            publish(encode(COMMAND_ROOM_LEAVE, sender=session.nick, recipient=name))
+        if quiet:
+            pass
+        elif grace and RESUME_GRACE > 0 and SOCKET:
+            deadline = time.monotonic() + RESUME_GRACE
+            GHOSTS[session.nick] = (deadline, session.key)
+            heapq.heappush(GRACE, (deadline, session.nick))
+        else:
+            leave(session.nick)
+    if session.state == STATE_PEER: # Worker is gone, so are its users.
+        PEERS.pop(session.worker, None)
+        for nick in [n for n, (peer, _) in REMOTE.items() if peer is session]:
+            del REMOTE[nick]
+            ROSTER.change(nick, None)
+        for room in list(ROOMS.values()):
+            for nick in [n for n, member in room.members.items() if member is session]:
+                leave_room(room, nick)
+
+def reject(session, reason):
+    """
+    Refuse a handshake, the reason is written before the connection closes.
+    """
+    STATS.handshake_failures.inc()
+    send(session, encode(COMMAND_REJECT, reason))
+    flush(session) # A few bytes into an empty socket buffer, close would discard them.
+    close(session)
+
+def leave(nick):
+    """
+    Tell everyone nick is gone, on every worker.
+    """
+    print("{} has left the chat!".format(nick.capitalize()))
+    ROSTER.change(nick, None)
+    publish(encode(COMMAND_BUS_LEAVE, sender=nick))
+
+def expire_ghosts():
+    """
+    Users who did not resume in time leave, return seconds until the next deadline.
+    """
+    now = time.monotonic()
+    while GRACE:
+        deadline, nick = GRACE[0]
+        if GHOSTS.get(nick, (None,))[0] != deadline:
+            heapq.heappop(GRACE) # Resumed already.
+            continue
+        if deadline > now:
+            return (deadline - now)
+        heapq.heappop(GRACE)
+        del GHOSTS[nick]
+        leave(nick)
+    return None
+
+def publish(frame):
+    """
+    Send a bus frame to every other worker.
+    """
+    for peer in list(PEERS.values()):
+        send(peer, frame)
+
+def accept():
+    """
+    Accept pending clients, each one starts in the handshake state.
+    """
+    while True:
+        try:
+            conn, addr = SOCKET.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        conn.setblocking(False)
+        STATS.connections.inc()
+        session = Session(conn, time.monotonic() + HANDSHAKE_TIMEOUT)
+        REGISTRY.add(session)
+        SELECTOR.register(conn, selectors.EVENT_READ, session)
+        heapq.heappush(HANDSHAKES, (session.deadline, session.fd, session))
+        session.nonce = os.urandom(16)
+        send(session, encode(COMMAND_PARAMS, "{},{};{};{},{}".format(*PARAMS, format_suites(CIPHERS), SERVER_KEY[1], session.nonce.hex()))) # Send Diffie-Hellman parameters and the cipher suites to the client.
+
+def expire_handshakes():
+    """
+    Close clients which did not finish the handshake in time, return seconds until the next deadline.
+    """
+    now = time.monotonic()
+    while HANDSHAKES:
+        deadline, _, session = HANDSHAKES[0]
+        if session not in REGISTRY or session.state != STATE_HANDSHAKE:
+            heapq.heappop(HANDSHAKES) # Finished or closed already.
+            continue
+        if deadline > now:
+            return (deadline - now)
+        heapq.heappop(HANDSHAKES)
+        STATS.handshake_failures.inc()
+        close(session)
+    return None
+
+def valid_nick(nick):
+    return (0 < len(nick) <= 32) and not any(c in nick for c in ",: \t\r\n")
+
+def valid_room(name):
+    return name.startswith('#') and valid_nick(name)
+
+def multicast(room, frame, excluded=None, remote=True):
+    """
+    Queue one encoded frame for every member of room, the buffer is shared.
+    Members on another worker are reached with a single copy per worker, unless remote is False.
+    """
+    peers = set()
+    for member in list(room.members.values()):
+        if member is excluded:
+            continue
+        if member.state == STATE_PEER:
+            if remote:
+                peers.add(member)
+        else:
+            send(member, frame)
+    for peer in peers:
+        send(peer, frame)
+
+def join_room(room, nick, member, stamp):
+    """
+    Add nick to room, member is the local session or the bus session of its worker. Local members are told.
+    """
+    ROOMS[room.name] = room
+    room.members[nick] = member
+    room.stamps[nick] = stamp
+    if member.state != STATE_PEER:
+        member.rooms.add(room.name)
+    multicast(room, encode(COMMAND_ROOM_JOIN, str(stamp), nick, room.name), member, False)
+
+def leave_room(room, nick):
+    """
+    Remove nick from room, local members are told, empty rooms are dropped.
+    """
+    member = room.members.pop(nick, None)
+    if member is None:
+        return
+    del room.stamps[nick]
+    if member.state != STATE_PEER:
+        member.rooms.discard(room.name)
+    if not room.members:
+        del ROOMS[room.name]
+    else:
+        multicast(room, encode(COMMAND_ROOM_LEAVE, sender=nick, recipient=room.name), None, False)
+
+def on_room(session, frame):
+    """
+    Join or leave a room, or send a message to every member. The message is encoded once,
+    every member and every worker with members gets the same buffer.
+    """
+    name, nick = frame.recipient, session.nick
+    if frame.type == COMMAND_ROOM_JOIN:
+        if not valid_room(name) or name in session.rooms:
+            return
+        room, stamp = (ROOMS.get(name) or Room(name)), time.time_ns()
+        join_room(room, nick, session, stamp)
+        send(session, encode(COMMAND_ROOM_MEMBERS, ",".join("{}:{}".format(n, room.stamps[n]) for n in room.order()), recipient=name))
+        publish(encode(COMMAND_ROOM_JOIN, str(stamp), nick, name))
+    elif frame.type == COMMAND_ROOM_LEAVE:
+        if name in session.rooms:
+            leave_room(ROOMS[name], nick)
+            publish(encode(COMMAND_ROOM_LEAVE, sender=nick, recipient=name))
+    elif name in session.rooms:
+        start = time.perf_counter()
+        multicast(ROOMS[name], encode(COMMAND_ROOM_MESSAGE, frame.payload, nick, name), session)
+        session.messages_in += 1
+        STATS.room_messages.inc()
+        STATS.routing_time.observe(time.perf_counter() - start)
+
+def on_handshake(session, frame):
+    """
+    Receive nick and public key from new client, using the parameters we sent.
+    The key is kept as "key:suites" with the cipher suites we offered which the client can run,
+    it is what peers see in the roster and what tickets bind.
+    """
+    if frame.type == COMMAND_RESUME:
+        on_resume(session, frame)
+        return
+    head, _, suites = frame.payload.decode('ascii').partition(';')
+    nick, fields = frame.sender.lower(), head.split(',')
+    key, resume = fields[0], fields[1:]
+    suites = [v for v in CIPHERS if v in parse_suites(suites)]
+    if frame.type != COMMAND_HELLO or not key.isdigit() or not all(v.isdigit() for v in resume):
+        reject(session, "Bad handshake")
+        return
+    if not valid_nick(nick):
+        reject(session, "Nicknames are 1 to 32 characters, without spaces, commas or colons")
+        return
+    if not suites:
+        reject(session, "No cipher suite in common with the server, it offers {}".format(", ".join(CIPHER_NAMES[v] for v in CIPHERS)))
+        return
+    if nick in GHOSTS:
+        reject(session, "Nickname {} is held for a dropped connection, try again in {} seconds".format(nick, int(GHOSTS[nick][0] - time.monotonic()) + 1))
+        return
+    if nick in REMOTE or not REGISTRY.register(session, nick, "{}:{}".format(key, format_suites(suites))):
+        reject(session, "Nickname {} is taken".format(nick))
+        return
+    STATS.handshakes.inc()
+    STATS.handshake_time.observe(time.monotonic() - (session.deadline - HANDSHAKE_TIMEOUT))
+    key = session.key
+    publish(encode(COMMAND_BUS_JOIN, key, sender=nick))
+    print("{} has joined the chat!".format(nick.capitalize()))
+    send(session, encode(COMMAND_TICKET, issue_ticket(TICKET_SECRET, nick, key, TICKET_TTL)))
+    JOINING.append((session, tuple(int(v) for v in resume) if len(resume) == 2 else None))
+    ROSTER.change(nick, key) # Everyone hears of it with the next batch, this client gets the roster then.
+
+def on_resume(session, frame):
+    """
+    A returning client with a ticket keeps its nick and public key, no key exchange and no join.
+    Peers only notice if the user had already left, otherwise the resume is invisible to them.
+    The ticket is sent in clear, the proof shows the client holds the private key of the ticket,
+    so a replayed ticket can not take over the nick.
+    """
+    proof, ticket = frame.payload[RESUME.size:(RESUME.size + DIGEST_SIZE)], frame.payload[(RESUME.size + DIGEST_SIZE):]
+    user = verify_ticket(TICKET_SECRET, ticket) if ticket else None
+    if user is None or user[0] != frame.sender.lower() or any(v not in CIPHERS for v in parse_suites(user[1].partition(':')[2])) or not hmac.compare_digest(proof, resume_proof(get_shared_key(int(user[1].partition(':')[0]), SERVER_KEY[0], PARAMS[0]), session.nonce, ticket)):
+        STATS.resume_failures.inc()
+        send(session, encode(COMMAND_RESUME)) # Refused, the client falls back to a full handshake.
+        return
+    nick, key = user
+    stale, remote = REGISTRY.find(nick), REMOTE.get(nick)
+    if (stale is not None and stale.key != key) or (remote is not None and remote[1] != key) or (nick in GHOSTS and GHOSTS[nick][1] != key):
+        STATS.resume_failures.inc()
+        send(session, encode(COMMAND_RESUME)) # The nick went to someone else meanwhile.
+        return
+    if stale is not None: # The old connection is not known to be dead yet.
+        close(stale, True)
+    ghost = GHOSTS.pop(nick, None)
+    REMOTE.pop(nick, None) # Moved here from another worker.
+    REGISTRY.register(session, nick, key)
+    STATS.resumes.inc()
+    if ghost is None and stale is None:
+        if remote is None: # Left already, this is a plain join without the key exchange.
+            print("{} has joined the chat!".format(nick.capitalize()))
+            ROSTER.change(nick, key)
+        publish(encode(COMMAND_BUS_JOIN, key, sender=nick)) # The other workers route to us from now on.
+    send(session, encode(COMMAND_TICKET, issue_ticket(TICKET_SECRET, nick, key, TICKET_TTL)))
+    epoch, version = RESUME.unpack_from(frame.payload)
+    JOINING.append((session, (epoch, version) if epoch >= 0 else None))
+    ROSTER.schedule()
+
+def on_message(session, frame):
+    """
+    Route a message, or a file transfer frame, to the recipient. Frames are relayed one at a time, never buffered whole.
+    """
+    if frame.type in ROOM_COMMANDS:
+        on_room(session, frame)
+        return
+    if frame.type == COMMAND_LEAVE:
+        close(session, grace=False)
+        return
+    if frame.type not in ROUTED:
+        return
+    start = time.perf_counter()
+    to_user, from_user, msg = frame.recipient, session.nick, frame.payload
+    recipient = REGISTRY.find(to_user)
+    if recipient is None and to_user in REMOTE: # Recipient lives on another worker, relay over the bus.
+        recipient = REMOTE[to_user][0]
+    if recipient is not None:
+        if frame.type == COMMAND_MESSAGE:
+            print("From {} to {}, MSG -> {} bytes, {}{}.".format(from_user.capitalize(), to_user.capitalize(), len(msg), CIPHER_NAMES.get(msg[0] if msg else None, "unknown cipher"), (", '{}'".format(get_bytes_as_bits(msg[1:])) if DEBUG else "")))
+        send(recipient, encode(frame.type, msg, from_user, to_user))
+        session.messages_in += 1
+        recipient.messages_out += 1
+        STATS.routed.inc()
+        STATS.routing_time.observe(time.perf_counter() - start)
+    else:
+        STATS.unroutable.inc()
+
+def on_bus(peer, frame):
+    """
+    Handle a frame from another worker, roster changes or a frame for one of our users.
+    """
+    if frame.type == COMMAND_BUS_JOIN:
+        key = frame.payload.decode('ascii')
+        local = REGISTRY.find(frame.sender)
+        if local is not None and local.key != key: # Both workers accepted the nick at once, the lowest worker id keeps it.
+            if peer.worker > WORKER_ID:
+                return
+            close(local, True)
+        elif local is not None: # The user resumed on the other worker.
+            close(local, True)
+        GHOSTS.pop(frame.sender, None)
+        if frame.sender in REMOTE and REMOTE[frame.sender][1] != key and REMOTE[frame.sender][0].worker < peer.worker:
+            return
+        REMOTE[frame.sender] = (peer, key)
+        ROSTER.change(frame.sender, key)
+    elif frame.type == COMMAND_BUS_LEAVE:
+        if REMOTE.get(frame.sender, (None,))[0] is peer:
+            del REMOTE[frame.sender]
+            ROSTER.change(frame.sender, None)
+    elif frame.type == COMMAND_ROOM_JOIN:
+        if valid_room(frame.recipient) and frame.sender in REMOTE and frame.payload.isdigit():
+            join_room(ROOMS.get(frame.recipient) or Room(frame.recipient), frame.sender, peer, int(frame.payload))
+    elif frame.type == COMMAND_ROOM_LEAVE:
+        room = ROOMS.get(frame.recipient)
+        if room is not None and room.members.get(frame.sender) is peer:
+            leave_room(room, frame.sender)
+    elif frame.type == COMMAND_ROOM_MESSAGE:
+        room = ROOMS.get(frame.recipient)
+        if room is not None and room.members.get(frame.sender) is peer:
+            multicast(room, encode(frame.type, frame.payload, frame.sender, frame.recipient), None, False)
+    elif frame.type in ROUTED:
+        recipient = REGISTRY.find(frame.recipient)
+        if recipient is not None:
+            send(recipient, encode(frame.type, frame.payload, frame.sender, frame.recipient))
+
+def on_readable(session):
+    """
+    Receive into the session buffer and handle every complete frame.
+    """
+    try:
+        received = session.parser.recv_into(session.sock)
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError:
+        received = 0
+    if not received:
+        close(session)
+        return
+    session.bytes_in += received
+    STATS.bytes_in.inc(received)
+    try:
+        for frame in session.parser:
+            if session not in REGISTRY:
+                break
+            if session.state == STATE_PEER:
+                on_bus(session, frame)
+            elif session.state == STATE_HANDSHAKE:
+                on_handshake(session, frame)
+            else:
+                on_message(session, frame)
+    except (ProtocolError, UnicodeDecodeError):
+        close(session) # Malformed data.
+
+def next_timeout():
+    """
+    Seconds until the next handshake deadline, grace deadline or roster batch, None to wait for socket events only.
+    """
+    timeouts = [t for t in (expire_handshakes(), expire_ghosts(), ROSTER.timeout()) if t is not None]
+    return min(timeouts) if timeouts else None
+
+def flush_roster():
+    """
+    Send the joins and leaves gathered during the batch window as one frame, shared by every client.
+    Clients which joined meanwhile get the roster instead, new ones share one snapshot.
+    """
+    global JOINING
+    if ROSTER.deadline is None or ROSTER.deadline > time.monotonic():
+        return
+    frame = ROSTER.flush()
+    joining, JOINING = JOINING, []
+    if frame:
+        broadcast(frame, {session for session, _ in joining})
+    snapshot = None
+    for session, resume in joining:
+        if session not in REGISTRY:
             continue
+        if resume: # Only the changes since the version it knows, if still in the log.
+            frames = ROSTER.resume(resume[0], resume[1], session.nick)
+        else:
+            snapshot = snapshot or ROSTER.snapshot()
+            frames = snapshot
+        for roster in frames:
+            send(session, roster)
+
+def serve():
+    """
+    Event loop, wake up on socket events, the next handshake deadline or roster batch.
+    """
+    while SOCKET:
+        events = SELECTOR.select(next_timeout())
+        flush_roster()
+        for key, mask in events:
+            session = key.data
+            if session is None:
+                accept()
+                continue
+            if session is ADMIN:
+                ADMIN.on_event(key.fileobj)
+                continue
+            if (mask & selectors.EVENT_READ) and session in REGISTRY:
+                on_readable(session)
+            if (mask & selectors.EVENT_WRITE) and session in REGISTRY:
+                flush(session)
+
+def listen(port, reuse_port=False):
+    """
+    Create the non-blocking listening socket, workers share the port with SO_REUSEPORT.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # The kernel spreads new connections over the workers.
+    sock.bind(('localhost', port))
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+    return sock
+
+def setup_metrics():
+    """
+    Create the metrics of this process, recording one is a single addition or bisect.
+    """
+    global METRICS, STATS
+    METRICS = Metrics(labels={'worker': WORKER_ID})
+    STATS = SimpleNamespace(
+        connections=METRICS.counter('connections_total', 'Accepted connections.'),
+        handshakes=METRICS.counter('handshakes_total', 'Completed handshakes.'),
+        handshake_failures=METRICS.counter('handshake_failures_total', 'Handshakes rejected or timed out.'),
+        resumes=METRICS.counter('resumes_total', 'Sessions resumed with a ticket.'),
+        resume_failures=METRICS.counter('resume_failures_total', 'Resumes refused, bad or expired ticket.'),
+        routed=METRICS.counter('frames_routed_total', 'Messages and file frames routed to a recipient.'),
+        room_messages=METRICS.counter('room_messages_total', 'Room messages multicast to the members.'),
+        unroutable=METRICS.counter('frames_unroutable_total', 'Routed frames for an unknown recipient.'),
+        bytes_in=METRICS.counter('bytes_in_total', 'Bytes received from clients and workers.'),
+        bytes_out=METRICS.counter('bytes_out_total', 'Bytes sent to clients and workers.'),
+        dropped=METRICS.counter('dropped_total', 'Frames dropped by the slow consumer policy.'),
+        slow_disconnects=METRICS.counter('slow_consumer_disconnects_total', 'Clients closed by the slow consumer policy.'),
+        disconnects=METRICS.counter('disconnects_total', 'Closed connections.'),
+        users=METRICS.gauge('users', 'Users registered on this worker.', lambda: len(REGISTRY.nicks)),
+        remote_users=METRICS.gauge('remote_users', 'Users registered on other workers.', lambda: len(REMOTE)),
+        ghosts=METRICS.gauge('ghosts', 'Dropped users held for resumption.', lambda: len(GHOSTS)),
+        rooms=METRICS.gauge('rooms', 'Rooms with at least one member.', lambda: len(ROOMS)),
+        roster_version=METRICS.gauge('roster_version', 'Changes made to the roster since this worker started.', lambda: ROSTER.version),
+        sessions=METRICS.gauge('sessions', 'Open connections, including handshakes and workers.', lambda: len(REGISTRY)),
+        queued=METRICS.gauge('outbound_queue_bytes', 'Bytes waiting in outbound queues.', lambda: sum(s.queued for s in REGISTRY)),
+        queued_max=METRICS.gauge('outbound_queue_max_bytes', 'Largest outbound queue.', lambda: max([s.queued for s in REGISTRY] or [0])),
+        handshake_time=METRICS.histogram('handshake_seconds', 'Time from accept to a registered nick.'),
+        routing_time=METRICS.histogram('routing_seconds', 'Time to route a frame to the recipient queue.'),
+    )
+
+def start(listener, peers=None):
+    """
+    Set up the event loop for this process, with bus connections to the other workers.
+    """
+    global SOCKET, SELECTOR, REGISTRY, ROSTER, HANDSHAKES, ADMIN
+    setup_metrics()
+    REGISTRY = Registry()
+    ROSTER = Roster()
+    HANDSHAKES = []
+    SELECTOR = selectors.DefaultSelector() # epoll/kqueue where available.
+    SOCKET = listener
+    SELECTOR.register(SOCKET, selectors.EVENT_READ)
+    for worker, sock in (peers or {}).items():
+        sock.setblocking(False)
+        peer = Session(sock)
+        peer.state, peer.worker = STATE_PEER, worker
+        REGISTRY.add(peer)
+        SELECTOR.register(sock, selectors.EVENT_READ, peer)
+        PEERS[worker] = peer
+    if ADMIN_PORT:
+        ADMIN = AdminServer(METRICS, ADMIN_PORT + WORKER_ID)
+        ADMIN.register(SELECTOR)
+
+def supervisor_signal_handler(sig, frame):
+    for pid in WORKERS:
         try:
-            s.sendall(text)
-        except:
-            s.close()
-            CONNECTIONS.remove(s)
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    sys.exit(0)
+
+def supervise(port, workers):
+    """
+    Fork the workers, each one has its own listening socket on the shared port,
+    and a Unix socket to every other worker which makes up the bus.
+    """
+    global WORKER_ID
+    sys.stdout.flush() # Children must not inherit buffered output.
+    links = {(i, j): socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM) for i in range(workers) for j in range(i + 1, workers)}
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal_handler)
+            WORKER_ID = i
+            peers = {}
+            for (a, b), (sa, sb) in links.items():
+                if a == i:
+                    peers[b] = sa
+                    sb.close()
+                elif b == i:
+                    peers[a] = sb
+                    sa.close()
+                else:
+                    sa.close()
+                    sb.close()
+            try:
+                start(listen(port, True), peers)
+                serve()
+            finally:
+                os._exit(0)
+        WORKERS.append(pid)
+    for sa, sb in links.values():
+        sa.close()
+        sb.close()
+    signal.signal(signal.SIGINT, supervisor_signal_handler)
+    signal.signal(signal.SIGTERM, supervisor_signal_handler)
+    for _ in WORKERS:
+        os.wait()
 
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal_handler)
-    PORT = int(sys.argv[1] if len(sys.argv) > 1 else 5000)
-    CONNECTIONS = [] # List of active sockets.
-    PUBLIC_KEYS = {} # List of public keys linked to nickname + socket, etc.
-    SOCKET = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    SOCKET.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    SOCKET.bind(('localhost', PORT))
-    SOCKET.listen(10)
-    CONNECTIONS.append(SOCKET)
-    q,a = generate_dh_parameters() # Diffie-Hellman params for this session.
-
-    print('Starting Secure Chat Server -> localhost:{}.'.format(PORT))
-    print('Session uses DH parameters, q={} and a={}.\n'.format(q, a))
+    parser = argparse.ArgumentParser(description='Secure Chat Server')
+    parser.add_argument('port', nargs='?', type=int, default=5000)
+    parser.add_argument('--high-water', type=int, default=HIGH_WATER, help='Max bytes queued per client.')
+    parser.add_argument('--slow-consumer', choices=POLICIES, default=SLOW_CONSUMER_POLICY, help='What to do when a client exceeds the high-water mark.')
+    parser.add_argument('--dh-bits', type=dh_bits, default=None, help='Size of the Diffie-Hellman prime q, at least {} bits, safe primes above {} bits.'.format(DH_MIN_BITS, DH_SAFE_ABOVE))
+    parser.add_argument('--dh-safe', action='store_true', help='Use a safe prime q = 2p+1.')
+    parser.add_argument('--dh-pool', default=DH_POOL, help='Pool of pregenerated groups to draw from, see dh.py.')
+    parser.add_argument('--admin-port', type=int, default=None, help='Serve /metrics and /stats over HTTP on this port, workers use the following ports.')
+    parser.add_argument('--resume-grace', type=float, default=RESUME_GRACE, help='Seconds a dropped client may resume before peers see it leave, 0 to disable.')
+    parser.add_argument('--ticket-ttl', type=int, default=TICKET_TTL, help='Seconds a resumption ticket is valid.')
+    parser.add_argument('--ciphers', type=lambda v: tuple(cipher_id(name) for name in v.split(',')), default=CIPHERS, help='Cipher suites offered, most preferred first, from {}.'.format(", ".join(CIPHER_NAMES.values())))
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes sharing the port, 0 for one per core.')
+    args = parser.parse_args()
+    PORT = args.port
+    HIGH_WATER = args.high_water
+    SLOW_CONSUMER_POLICY = args.slow_consumer
+    ADMIN_PORT = args.admin_port
+    RESUME_GRACE = args.resume_grace
+    TICKET_TTL = args.ticket_ttl
+    CIPHERS = args.ciphers
+    TICKET_SECRET = get_ticket_secret() # Before the workers fork, they all share it.
+    workers = args.workers or os.cpu_count() or 1
+    PARAMS = get_dh_parameters(args.dh_bits, args.dh_safe, args.dh_pool) # Diffie-Hellman params for this session, shared by all workers.
+    private_key = get_private_key(PARAMS[0])
+    SERVER_KEY = (private_key, get_public_key(private_key, *PARAMS))
 
-    while SOCKET:
-        available_sockets, _, _ = select.select(CONNECTIONS, [], []) # Only check sockets that are available. Otherwise the main thread will block and wait forever.
-        for socket in available_sockets:
-            if socket == SOCKET:
-                conn, addr = SOCKET.accept()
-                CONNECTIONS.append(conn)
-                conn.sendall("{},{}".format(q,a).encode('ascii')) # Send Diffie-Hellman parameters to the client.
-                data = conn.recv(BUFFER) # Receive public key from new client, using the parameters we just sent!
-                if data:
-                    v = data.decode('ascii').lower().split(',')
-                    PUBLIC_KEYS[conn] = {'nick': v[0], 'key': v[1]}
-                    broadcast("{},{}:{}".format(COMMAND_CONNECT,v[0],v[1]), conn)
-                    print("{} has joined the chat!".format(v[0].capitalize()))
-                    if len(PUBLIC_KEYS.keys()) > 1: # Send all other clients to this new client.
-                        conn.sendall("{},{}".format(COMMAND_CONNECT,",".join(["{}:{}".format(x['nick'], x['key']) for o,x in PUBLIC_KEYS.items() if o != conn])).encode('ascii'))
-            else: # Handle messages from other clients.
-                try:
-                    data = socket.recv(BUFFER)
-                    if data:
-                        data = data.decode('ascii').split(',') # <to user> <message>
-                        if data and len(data) == 2:
-                            to_user, from_user, msg = data[0], PUBLIC_KEYS[socket]['nick'], data[1]
-                            for o, v in PUBLIC_KEYS.items():
-                                if v['nick'] == to_user:
-                                    print("From {} to {}, MSG -> '{}'.".format(from_user.capitalize(), to_user.capitalize(), get_as_text(msg)))
-                                    o.sendall("{},{},{}".format(COMMAND_MESSAGE,from_user,msg).encode('ascii'))
-                                    break
-                    else:
-                        socket.close()
-                        if socket in CONNECTIONS:
-                            CONNECTIONS.remove(socket)
-                        if socket in PUBLIC_KEYS:
-                            del PUBLIC_KEYS[socket]
-                except:
-                    socket.close()
-                    if socket in CONNECTIONS:
-                        CONNECTIONS.remove(socket)
-                    if socket in PUBLIC_KEYS:
-                        print("{} has left the chat!".format(PUBLIC_KEYS[socket]['nick'].capitalize()))
-                        broadcast("{},{}".format(COMMAND_DISCONNECT,PUBLIC_KEYS[socket]['nick']))                        
-                        del PUBLIC_KEYS[socket]
+    print('Starting Secure Chat Server -> localhost:{}{}.'.format(PORT, (", {} workers".format(workers) if workers > 1 else "")))
+    print('Session uses DH parameters, q={} and a={}, cipher suites {}.\n'.format(*PARAMS, ", ".join(CIPHER_NAMES[v] for v in CIPHERS)))
 
+    if workers > 1:
+        supervise(PORT, workers)
+    else:
+        start(listen(PORT))
+        serve()
     terminate()
     print("Terminated")
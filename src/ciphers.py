@@ -0,0 +1,159 @@
+#
+# Cipher suites, a common interface over the ciphers a pair of clients can use
+#
+# The server advertises the suites it allows with the Diffie-Hellman parameters, most preferred first.
+# Each client answers with the ones it can run here, two peers use the first suite in the server's
+# order that both of them announced. Every message names its suite, so the receiver never has to guess.
+#
+
+import os
+import hashlib
+import numpy as np
+from bbs import blum_blum_shub
+from sdes import get_tables, as_buffer
+from protocol import CIPHER_SDES, CIPHER_AES, CIPHER_SHAKE, CIPHER_NAMES
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError: # Optional, AES is only offered where the package is installed.
+    Cipher = None
+
+class CipherSuite:
+    """
+    A cipher and how its key is derived from the Diffie-Hellman shared key. Keys are opaque,
+    whatever derive returns is passed back to the other methods.
+    Ciphertext is overhead bytes (a nonce) longer than the plaintext.
+    """
+    id = None
+    name = None
+    key_bits = None
+    block_size = None # Bytes.
+    overhead = 0
+
+    def derive(self, shared):
+        raise NotImplementedError
+
+    def encrypt_into(self, key, data, out):
+        """
+        Encrypt data into the writable buffer out, which holds at least len(data) + overhead bytes.
+        Returns the number of bytes written.
+        """
+        raise NotImplementedError
+
+    def decrypt_into(self, key, data, out):
+        raise NotImplementedError
+
+    def encrypt(self, key, data):
+        out = bytearray(len(data) + self.overhead)
+        return bytes(out[:self.encrypt_into(key, data, out)])
+
+    def decrypt(self, key, data):
+        out = bytearray(max(0, len(data) - self.overhead))
+        return bytes(out[:self.decrypt_into(key, data, out)])
+
+def shared_bytes(shared, label):
+    """
+    Key material for a suite, a hash of the shared key so every suite gets an independent key.
+    """
+    return hashlib.sha256(label + shared.to_bytes(max(1, (shared.bit_length() + 7) // 8), 'big')).digest()
+
+class SdesSuite(CipherSuite):
+    """
+    Table driven S-DES, every byte is substituted through the 256 entry table of the key.
+    The key is the 10-bit BBS secret the chat has always used.
+    """
+    id = CIPHER_SDES
+    name = CIPHER_NAMES[CIPHER_SDES]
+    key_bits = 10
+    block_size = 1
+
+    def derive(self, shared):
+        return get_tables(blum_blum_shub(10, shared))
+
+    def encrypt_into(self, key, data, out):
+        data = as_buffer(data)
+        np.take(key[0], data, out=np.frombuffer(out, dtype=np.uint8, count=len(data)))
+        return len(data)
+
+    def decrypt_into(self, key, data, out):
+        data = as_buffer(data)
+        np.take(key[1], data, out=np.frombuffer(out, dtype=np.uint8, count=len(data)))
+        return len(data)
+
+    def encrypt(self, key, data):
+        return key[0][as_buffer(data)].tobytes()
+
+    def decrypt(self, key, data):
+        return key[1][as_buffer(data)].tobytes()
+
+class NonceSuite(CipherSuite):
+    """
+    A cipher with a random nonce per message, sent in front of the ciphertext.
+    Encryption and decryption are the same transform.
+    """
+    overhead = 16
+
+    def transform_into(self, key, nonce, data, out):
+        raise NotImplementedError
+
+    def encrypt_into(self, key, data, out):
+        nonce = os.urandom(self.overhead)
+        out = memoryview(out)
+        out[:self.overhead] = nonce
+        return self.overhead + self.transform_into(key, nonce, data, out[self.overhead:])
+
+    def decrypt_into(self, key, data, out):
+        data = memoryview(data)
+        return self.transform_into(key, bytes(data[:self.overhead]), data[self.overhead:], out)
+
+class AesSuite(NonceSuite):
+    """
+    AES-128 in counter mode from the cryptography package, native code and AES-NI where the CPU has it.
+    The nonce is the initial counter block.
+    """
+    id = CIPHER_AES
+    name = CIPHER_NAMES[CIPHER_AES]
+    key_bits = 128
+    block_size = 16
+
+    def derive(self, shared):
+        return shared_bytes(shared, b"aes-128-ctr")[:16]
+
+    def transform_into(self, key, nonce, data, out):
+        context = Cipher(algorithms.AES(key), modes.CTR(nonce)).encryptor() # Counter mode decrypts with the same keystream.
+        out = memoryview(out)
+        if len(out) >= (len(data) + self.block_size - 1): # update_into wants room for a whole block more.
+            return context.update_into(data, out)
+        chunk = context.update(data)
+        out[:len(chunk)] = chunk
+        return len(chunk)
+
+class ShakeSuite(NonceSuite):
+    """
+    Stream cipher on SHAKE256 from hashlib, the keystream is SHAKE256(key + nonce) XORed with the data.
+    Always available, no dependency beyond the standard library and numpy.
+    """
+    id = CIPHER_SHAKE
+    name = CIPHER_NAMES[CIPHER_SHAKE]
+    key_bits = 256
+    block_size = 1
+
+    def derive(self, shared):
+        return shared_bytes(shared, b"shake256")
+
+    def transform_into(self, key, nonce, data, out):
+        data = as_buffer(data)
+        keystream = np.frombuffer(hashlib.shake_256(key + nonce).digest(len(data)), dtype=np.uint8)
+        np.bitwise_xor(data, keystream, out=np.frombuffer(out, dtype=np.uint8, count=len(data)))
+        return len(data)
+
+SUITES = {suite.id: suite for suite in (SdesSuite(), ShakeSuite()) + ((AesSuite(),) if Cipher is not None else ())} # Suites which can run here.
+
+def choose(offered, *supported):
+    """
+    First suite in the offered order which is in every supported list, None if there is none.
+    """
+    for suite_id in offered:
+        if all(suite_id in s for s in supported):
+            return suite_id
+    return None
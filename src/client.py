@@ -0,0 +1,659 @@
+#
+# Secure Chat Client library, blocking and asyncio variants
+#
+
+import os
+import socket
+import struct
+import asyncio
+import itertools
+import selectors
+from threading import Thread, Lock
+from collections import namedtuple
+from bbs import blum_blum_shub
+from dh import get_private_key, get_public_key, get_shared_key, get_key_pool
+from sdes import get_tables, apply_table
+from ciphers import SUITES, choose
+from protocol import encode, encode_into, parse_suites, format_suites, CIPHER_SDES, FrameParser, RESUME, COMMAND_TICKET, COMMAND_RESUME, COMMAND_LEAVE, COMMAND_REJECT, COMMAND_CONNECT, COMMAND_DISCONNECT, COMMAND_MESSAGE, COMMAND_PARAMS, COMMAND_HELLO
+from protocol import COMMAND_FILE_OFFER, COMMAND_FILE_CHUNK, COMMAND_FILE_ACK, COMMAND_FILE_CANCEL, COMMAND_ROSTER
+from protocol import COMMAND_ROOM_JOIN, COMMAND_ROOM_LEAVE, COMMAND_ROOM_MEMBERS, COMMAND_ROOM_MESSAGE, COMMAND_ROOM_KEY
+from roster import parse_roster
+from tickets import resume_proof
+from transfer import OutgoingTransfer, IncomingTransfer, parse_offer, OFFER, CHUNK, ACK
+
+EVENT_JOIN = 'join' # data is the public key.
+EVENT_LEAVE = 'leave'
+EVENT_MESSAGE = 'message' # data is the decrypted text.
+EVENT_FILE_OFFER = 'file_offer' # data is (transfer id, name, size), answer with accept_file or reject_file.
+EVENT_FILE = 'file' # data is the path of a received file.
+EVENT_ROOM_JOIN = 'room_join' # nick joined room.
+EVENT_ROOM_LEAVE = 'room_leave'
+EVENT_ROOM_MESSAGE = 'room_message' # data is the decrypted text.
+EVENT_CLOSED = 'closed'
+
+Event = namedtuple('Event', ['type', 'nick', 'data', 'room', 'suite'], defaults=(None, None)) # suite is the cipher suite id of a message.
+
+ROOM_KEY = struct.Struct('!IB') # Key epoch (random) and room name length, followed by the name and the encrypted key.
+ROOM_MESSAGE = struct.Struct('!I') # Key epoch, followed by the ciphertext.
+ROOM_KEYS_KEPT = 4 # Older room keys kept for messages still in flight after a rekey.
+
+class Room:
+    """
+    A joined room, its members in the order of their join stamps (the first one is the owner) and its keys by epoch.
+    The owner makes the room key and sends it to every member over the pairwise channel,
+    a new key is made whenever a member leaves. Keys from anyone but the owner are ignored.
+    """
+    __slots__ = ('name', 'members', 'stamps', 'epoch', 'keys')
+
+    def __init__(self, name, members):
+        self.name = name
+        self.members = []
+        self.stamps = {} # nick -> join stamp from the server.
+        self.epoch = None # Current key epoch, None until we have a key.
+        self.keys = {} # epoch -> S-DES key.
+        for nick, stamp in members:
+            self.add(nick, stamp)
+
+    def owner(self):
+        return self.members[0] if self.members else None
+
+    def add(self, nick, stamp):
+        self.stamps[nick] = stamp
+        if nick not in self.members:
+            self.members.append(nick)
+        self.members.sort(key=lambda n: (self.stamps[n], n))
+
+    def remove(self, nick):
+        if nick in self.members:
+            self.members.remove(nick)
+            del self.stamps[nick]
+
+    def add_key(self, epoch, key):
+        """
+        Store the key for epoch and make it current, False if we already have one, an epoch's key never changes.
+        Keys come from the owner over one channel, in order, so the last one is the current one.
+        """
+        if epoch in self.keys:
+            return False
+        self.keys[epoch] = key
+        self.epoch = epoch
+        for old in list(self.keys)[:-ROOM_KEYS_KEPT]:
+            del self.keys[old]
+        return True
+
+FILE_FRAMES = {COMMAND_FILE_OFFER: OFFER.size, COMMAND_FILE_CHUNK: CHUNK.size, COMMAND_FILE_ACK: ACK.size, COMMAND_FILE_CANCEL: ACK.size} # Smallest payload of each.
+ROOM_FRAMES = (COMMAND_ROOM_JOIN, COMMAND_ROOM_LEAVE, COMMAND_ROOM_MEMBERS, COMMAND_ROOM_MESSAGE, COMMAND_ROOM_KEY)
+
+class ClientState:
+    """
+    Protocol state shared by both clients, the handshake and the peer key table.
+    No I/O happens here, frames go out through self.write.
+    """
+
+    def __init__(self, nick, downloads='.', report=print, key_pool=False, ciphers=None):
+        self.nick = nick
+        self.key_pool = key_pool # Take key pairs from the shared pregenerated pool, for many clients in one process.
+        self.ciphers = ciphers # Cipher suite ids we are willing to use, None for every one available here.
+        self.params = None
+        self.offered = None # Cipher suites the server allows, most preferred first.
+        self.suites = [] # The offered suites we announced.
+        self.private_key = None
+        self.public_key = None
+        self.keys = {} # Public key per peer nick.
+        self.session_keys = {} # Derived keys per peer nick, (public key, shared key, secret, tables).
+        self.peer_suites = {} # Cipher suites per peer nick, from the roster.
+        self.cipher_keys = {} # Suite keys per (peer nick, suite id), (public key, key).
+        self.roster_epoch = None # Roster version we are up to date with, resumed on reconnect.
+        self.roster_version = None
+        self.previous_keys = None # Roster before a snapshot started, to tell who joined and left.
+        self.rooms = {} # Joined rooms by name.
+        self.ticket = None # Resumption ticket from the server, opaque to us.
+        self.downloads = downloads
+        self.report = report
+        self.transfers_out = {}
+        self.transfers_in = {}
+        self.offers = {} # File offers waiting for the user, (peer nick, transfer id) -> offer payload.
+        self.transfer_ids = itertools.count(1)
+
+    def write(self, frame):
+        raise NotImplementedError
+
+    def hello(self, frame):
+        """
+        Take the Diffie-Hellman parameters, make our key pair and answer with our nick, public key
+        and the offered cipher suites we can run. With a ticket for the same group and suites,
+        ask to resume instead, keeping the key pair. The resume proves we hold the private key,
+        keyed by what we share with the server's key, over the nonce of this connection.
+        """
+        if frame is None or frame.type != COMMAND_PARAMS:
+            raise ConnectionError("Handshake failed")
+        params, offered, server = (frame.payload.decode('ascii').split(';') + ["", ""])[:3]
+        params, offered = tuple(int(v) for v in params.split(',')), parse_suites(offered)
+        self.rooms = {} # Memberships end with the connection.
+        if self.ticket and server and params == self.params and offered == self.offered: # Same group, keep our key pair and every shared key.
+            server_key, nonce = server.split(',')
+            epoch, version = (self.roster_epoch, self.roster_version) if self.roster_epoch is not None else (-1, -1)
+            proof = resume_proof(get_shared_key(int(server_key), self.private_key, params[0]), bytes.fromhex(nonce), self.ticket)
+            return encode(COMMAND_RESUME, RESUME.pack(epoch, version) + proof + self.ticket, sender=self.nick)
+        self.params, self.offered = params, offered
+        self.suites = [v for v in offered if v in SUITES and (self.ciphers is None or v in self.ciphers)]
+        if not self.suites:
+            raise ConnectionError("No cipher suite in common with the server")
+        q, a = self.params
+        if self.key_pool:
+            self.private_key, self.public_key = get_key_pool(q, a).pop()
+        else:
+            self.private_key = get_private_key(q)
+            self.public_key = get_public_key(self.private_key, q, a)
+        self.session_keys, self.cipher_keys = {}, {} # New private key, every shared key changes.
+        if self.roster_epoch is not None: # Reconnecting, only ask for the roster changes.
+            return encode(COMMAND_HELLO, "{},{},{};{}".format(self.public_key, self.roster_epoch, self.roster_version, format_suites(self.suites)), sender=self.nick)
+        return encode(COMMAND_HELLO, "{};{}".format(self.public_key, format_suites(self.suites)), sender=self.nick)
+
+    def joined(self, frame):
+        """
+        Check the answer to a hello or a resume, a ticket once we are in. False if a resume was refused,
+        the ticket is dropped and the next hello makes a full handshake. ConnectionError with the
+        reason if the server refused us.
+        """
+        if frame is None:
+            raise ConnectionError("Handshake failed")
+        if frame.type == COMMAND_REJECT:
+            raise ConnectionError(frame.payload.decode('utf-8', 'replace'))
+        if frame.type == COMMAND_TICKET:
+            self.ticket = frame.payload
+            return True
+        self.ticket = None
+        return False
+
+    def get_session_key(self, nick):
+        """
+        Derive the shared key, S-DES secret and cipher tables for nick once.
+        Cached until the user leaves or announces a different public key.
+        """
+        key = self.keys[nick]
+        entry = self.session_keys.get(nick)
+        if entry is None or entry[0] != key:
+            shared = get_shared_key(key, self.private_key, self.params[0])
+            secret = blum_blum_shub(10, shared) # Secret key!
+            entry = (key, shared, secret, get_tables(secret))
+            self.session_keys[nick] = entry
+        return entry
+
+    def get_cipher(self, nick, suite_id=None):
+        """
+        Cipher suite and its key for nick, by default the first offered suite both of us can run,
+        KeyError if there is none. None if we can not run the given suite.
+        """
+        if suite_id is None:
+            suite_id = choose(self.offered, self.suites, self.peer_suites.get(nick) or (CIPHER_SDES,))
+            if suite_id is None:
+                raise KeyError("No cipher suite in common with {}".format(nick))
+        suite = SUITES.get(suite_id)
+        if suite is None:
+            return None
+        key = self.keys[nick]
+        entry = self.cipher_keys.get((nick, suite_id))
+        if entry is None or entry[0] != key:
+            entry = (key, suite.derive(self.get_session_key(nick)[1]))
+            self.cipher_keys[(nick, suite_id)] = entry
+        return suite, entry[1]
+
+    def encrypt_message(self, nick, text):
+        """
+        The suite id and the ciphertext, encrypted straight into the frame.
+        """
+        nick = nick.lower()
+        if nick not in self.keys:
+            raise KeyError("Unknown user {}".format(nick))
+        suite, key = self.get_cipher(nick)
+        data = text.encode('utf-8')
+        frame, payload = encode_into(COMMAND_MESSAGE, 1 + len(data) + suite.overhead, recipient=nick)
+        payload[0] = suite.id
+        suite.encrypt_into(key, data, payload[1:])
+        return frame
+
+    def encrypt_room_message(self, name, text):
+        """
+        Encrypt once under the room key, the server hands the same frame to every member.
+        """
+        room = self.rooms.get(name)
+        if room is None or room.epoch is None:
+            raise KeyError("No key for room {} yet".format(name))
+        return encode(COMMAND_ROOM_MESSAGE, ROOM_MESSAGE.pack(room.epoch) + apply_table(get_tables(room.keys[room.epoch])[0], text.encode('utf-8')), recipient=name)
+
+    def share_room_key(self, room, nick):
+        """
+        Send the current room key to nick, encrypted under our pairwise key. Needs the public key of nick.
+        """
+        if room.epoch is None or nick not in self.keys or nick == self.nick.lower():
+            return
+        name = room.name.encode('utf-8')
+        key = apply_table(self.get_session_key(nick)[3][0], room.keys[room.epoch].to_bytes(2, 'big'))
+        self.write(encode(COMMAND_ROOM_KEY, ROOM_KEY.pack(room.epoch, len(name)) + name + key, recipient=nick))
+
+    def rekey_room(self, room):
+        """
+        Make a new room key and send it to every member, we are the owner.
+        """
+        epoch = int.from_bytes(os.urandom(4), 'big') # Random, a new owner does not know the epochs of the one before.
+        while epoch in room.keys:
+            epoch = int.from_bytes(os.urandom(4), 'big')
+        room.add_key(epoch, int.from_bytes(os.urandom(2), 'big') & 0x3FF) # S-DES keys are 10-bit.
+        for nick in room.members:
+            self.share_room_key(room, nick)
+
+    def handle_room(self, user, frame):
+        """
+        Room membership, keys and messages. Returns the resulting events.
+        """
+        me = self.nick.lower()
+        if frame.type == COMMAND_ROOM_KEY:
+            if len(frame.payload) < ROOM_KEY.size:
+                return []
+            length = ROOM_KEY.unpack_from(frame.payload)[1]
+            if len(frame.payload) != (ROOM_KEY.size + length + 2): # The name and a 16-bit key.
+                return []
+            name = frame.payload[ROOM_KEY.size:(ROOM_KEY.size + length)].decode('utf-8', 'replace')
+            room = self.rooms.get(name)
+            if room is not None and user == room.owner() and user in self.keys:
+                secret = int.from_bytes(apply_table(self.get_session_key(user)[3][1], frame.payload[(ROOM_KEY.size + length):]), 'big')
+                room.add_key(ROOM_KEY.unpack_from(frame.payload)[0], secret & 0x3FF)
+            return []
+        name = frame.recipient
+        if frame.type == COMMAND_ROOM_MEMBERS:
+            members = [entry.split(':') for entry in frame.payload.decode('utf-8').split(',')]
+            room = self.rooms[name] = Room(name, ((nick, int(stamp)) for nick, stamp in members))
+            if room.owner() == me:
+                self.rekey_room(room)
+            return [Event(EVENT_ROOM_JOIN, me, room.members, name)]
+        room = self.rooms.get(name)
+        if room is None:
+            return []
+        if frame.type == COMMAND_ROOM_JOIN:
+            owner = room.owner()
+            room.add(user, int(frame.payload))
+            if owner == me and room.owner() != me: # Joined at once on another worker, with an earlier stamp. Our key is void, wait for theirs.
+                room.epoch, room.keys = None, {}
+            if room.owner() == me:
+                self.share_room_key(room, user)
+            return [Event(EVENT_ROOM_JOIN, user, None, name)]
+        if frame.type == COMMAND_ROOM_LEAVE:
+            room.remove(user)
+            if room.owner() == me:
+                self.rekey_room(room) # The member who left must not read what follows.
+            return [Event(EVENT_ROOM_LEAVE, user, None, name)]
+        if frame.type == COMMAND_ROOM_MESSAGE and len(frame.payload) >= ROOM_MESSAGE.size:
+            key = room.keys.get(ROOM_MESSAGE.unpack_from(frame.payload)[0])
+            if key is None:
+                return []
+            return [Event(EVENT_ROOM_MESSAGE, user, apply_table(get_tables(key)[1], memoryview(frame.payload)[ROOM_MESSAGE.size:]).decode('utf-8', 'replace'), name)]
+        return []
+
+    def handle(self, frame):
+        """
+        Update the state with a frame from the server, return the resulting events.
+        Peer frames are relayed by the server unchecked, a malformed one is dropped instead of ending the connection.
+        """
+        try:
+            return self.handle_frame(frame)
+        except (struct.error, ValueError, IndexError) as e:
+            self.report("Dropped a malformed frame from {}: {}".format(frame.sender.capitalize(), e))
+            return []
+
+    def handle_frame(self, frame):
+        user = frame.sender.lower()
+        if frame.type == COMMAND_DISCONNECT: # A user disconnected, remove from our list.
+            self.keys.pop(user, None)
+            self.session_keys.pop(user, None)
+            return [Event(EVENT_LEAVE, user, None)]
+        if frame.type == COMMAND_CONNECT: # Users connected, store the public key and nickname for each.
+            events = []
+            for entry in frame.payload.decode('utf-8').split(','):
+                user, key = entry.split(':')
+                self.keys[user.lower()] = int(key)
+                events.append(Event(EVENT_JOIN, user.lower(), int(key)))
+            return events
+        if frame.type == COMMAND_ROSTER:
+            return self.handle_roster(frame.payload)
+        if frame.type == COMMAND_TICKET:
+            self.ticket = frame.payload
+            return []
+        if frame.type == COMMAND_MESSAGE and user in self.keys and frame.payload: # Decrypt with the suite the sender picked.
+            cipher = self.get_cipher(user, frame.payload[0])
+            if cipher is None:
+                return []
+            return [Event(EVENT_MESSAGE, user, cipher[0].decrypt(cipher[1], memoryview(frame.payload)[1:]).decode('utf-8', 'replace'), None, cipher[0].id)]
+        if frame.type in FILE_FRAMES:
+            return self.handle_file(user, frame)
+        if frame.type in ROOM_FRAMES:
+            return self.handle_room(user, frame)
+        return []
+
+    def handle_roster(self, payload):
+        """
+        Apply a roster snapshot page or delta. A snapshot replaces the roster, joins and leaves
+        are reported once its last page arrives.
+        """
+        epoch, version, kind, page, pages, entries = parse_roster(payload)
+        me, events = self.nick.lower(), []
+        if kind == 'S' and page == 0:
+            self.previous_keys, self.keys = self.keys, {}
+        for nick, key, suites in entries:
+            if nick == me:
+                continue
+            if key is not None:
+                self.peer_suites[nick] = suites
+            if kind == 'S':
+                self.keys[nick] = key
+            elif key is None:
+                if self.keys.pop(nick, None) is not None:
+                    self.session_keys.pop(nick, None)
+                    self.peer_suites.pop(nick, None)
+                    events.append(Event(EVENT_LEAVE, nick, None))
+            elif self.keys.get(nick) != key:
+                self.keys[nick] = key
+                events.append(Event(EVENT_JOIN, nick, key))
+        if kind == 'S':
+            if page < (pages - 1):
+                return events
+            previous, self.previous_keys = (self.previous_keys or {}), None
+            for nick in previous:
+                if nick not in self.keys:
+                    self.session_keys.pop(nick, None)
+                    self.peer_suites.pop(nick, None)
+                    events.append(Event(EVENT_LEAVE, nick, None))
+            events.extend(Event(EVENT_JOIN, nick, key) for nick, key in self.keys.items() if previous.get(nick) != key)
+        self.roster_epoch, self.roster_version = epoch, version
+        for event in events: # Room members we could not send the key to before.
+            if event.type == EVENT_JOIN:
+                for room in self.rooms.values():
+                    if event.nick in room.members and room.owner() == me:
+                        self.share_room_key(room, event.nick)
+        return events
+
+    def handle_file(self, user, frame):
+        """
+        File transfer frames, from a receiver (ack, cancel) or a sender (offer, chunk, cancel).
+        """
+        if len(frame.payload) < FILE_FRAMES[frame.type]:
+            return []
+        transfer_id = ACK.unpack_from(frame.payload)[0]
+        if frame.type == COMMAND_FILE_OFFER and user in self.keys: # Nothing is written before the user accepts.
+            _, size, _, name = parse_offer(frame.payload)
+            self.offers[(user, transfer_id)] = frame.payload
+            return [Event(EVENT_FILE_OFFER, user, (transfer_id, name, size))]
+        elif frame.type == COMMAND_FILE_CHUNK and (user, transfer_id) in self.transfers_in:
+            transfer = self.transfers_in[(user, transfer_id)]
+            reply = transfer.on_chunk(frame.payload)
+            if reply:
+                self.write(reply)
+            if transfer.done:
+                del self.transfers_in[(user, transfer_id)]
+                if transfer.received >= transfer.size:
+                    return [Event(EVENT_FILE, user, transfer.path)]
+        elif frame.type == COMMAND_FILE_ACK and transfer_id in self.transfers_out:
+            self.transfers_out[transfer_id].on_ack(ACK.unpack_from(frame.payload)[1])
+        elif frame.type == COMMAND_FILE_CANCEL:
+            if transfer_id in self.transfers_out and self.transfers_out[transfer_id].recipient == user:
+                self.transfers_out[transfer_id].cancel()
+            if (user, transfer_id) in self.transfers_in:
+                self.transfers_in.pop((user, transfer_id)).close()
+                self.report("Transfer from {} cancelled.".format(user.capitalize()))
+            if self.offers.pop((user, transfer_id), None) is not None:
+                self.report("{} withdrew the file offer.".format(user.capitalize()))
+        return []
+
+    def accept_file(self, nick, transfer_id):
+        """
+        Accept an offer, the file is written to downloads as it arrives. Returns the transfer, it is done
+        already for an empty file. None if the offer is gone or the file can not be created, the sender is told.
+        """
+        nick = nick.lower()
+        payload = self.offers.pop((nick, transfer_id), None)
+        if payload is None or nick not in self.keys:
+            return None
+        try:
+            transfer = IncomingTransfer(nick, payload, self.get_session_key(nick)[2], self.downloads, self.report)
+        except OSError as e: # Missing or read-only downloads directory.
+            self.report("Can not receive a file from {}: {}".format(nick.capitalize(), e))
+            self.write(encode(COMMAND_FILE_CANCEL, ACK.pack(transfer_id, 0), recipient=nick))
+            return None
+        if not transfer.done:
+            self.transfers_in[(nick, transfer_id)] = transfer
+        self.write(encode(COMMAND_FILE_ACK, ACK.pack(transfer_id, 0), recipient=nick)) # Opens the sender's window.
+        return transfer
+
+    def reject_file(self, nick, transfer_id):
+        nick = nick.lower()
+        if self.offers.pop((nick, transfer_id), None) is not None:
+            self.write(encode(COMMAND_FILE_CANCEL, ACK.pack(transfer_id, 0), recipient=nick))
+
+class SecureChatClient(ClientState):
+    """
+    Blocking client. The receive loop runs on a thread and sleeps in select until the
+    socket is readable, every event is passed to on_event.
+    """
+
+    def __init__(self, nick, host='localhost', port=5000, on_event=None, downloads='.', report=print, key_pool=False, ciphers=None):
+        super().__init__(nick, downloads, report, key_pool, ciphers)
+        self.address = (host, port)
+        self.on_event = on_event or (lambda event: None)
+        self.sock = None
+        self.parser = FrameParser()
+        self.send_lock = Lock() # Frames from several threads must not interleave.
+        self.thread = None
+        self.waiter = None # close writes to wakeup, the receive loop selects on waiter.
+        self.wakeup = None
+
+    def connect(self, timeout=10.0, start=True):
+        """
+        Connect and finish the handshake, then start the receive loop unless start is False.
+        """
+        self.sock = socket.create_connection(self.address, timeout)
+        self.parser = FrameParser()
+        params = self.receive()
+        self.write(self.hello(params))
+        if not self.joined(self.receive()): # The resume was refused, make a full handshake.
+            self.write(self.hello(params))
+            if not self.joined(self.receive()):
+                raise ConnectionError("Handshake failed")
+        self.sock.settimeout(None)
+        self.waiter, self.wakeup = socket.socketpair()
+        if start:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def write(self, frame):
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+    def receive(self):
+        """
+        Block until the next frame arrives, None once the connection is gone.
+        """
+        frame = self.parser.next_frame()
+        while frame is None:
+            if not self.parser.recv_into(self.sock):
+                return None
+            frame = self.parser.next_frame()
+        return frame
+
+    def run(self):
+        """
+        Receive loop, wakes up on data from the server or when close is called.
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        selector.register(self.waiter, selectors.EVENT_READ)
+        try:
+            while True:
+                for frame in self.parser: # Frames already buffered during the handshake.
+                    for event in self.handle(frame):
+                        self.on_event(event)
+                keys = [key.fileobj for key, _ in selector.select()]
+                if self.waiter in keys or not self.parser.recv_into(self.sock):
+                    break
+        except (OSError, ValueError) as e:
+            self.report(e)
+        finally:
+            selector.close()
+            self.on_event(Event(EVENT_CLOSED, self.nick, None))
+
+    def send_message(self, nick, text):
+        self.write(self.encrypt_message(nick, text))
+
+    def join_room(self, name):
+        self.write(encode(COMMAND_ROOM_JOIN, recipient=name))
+
+    def leave_room(self, name):
+        self.rooms.pop(name, None)
+        self.write(encode(COMMAND_ROOM_LEAVE, recipient=name))
+
+    def send_room_message(self, name, text):
+        self.write(self.encrypt_room_message(name, text))
+
+    def send_file(self, nick, path):
+        """
+        Stream a file to nick on its own thread, returns the transfer.
+        """
+        nick = nick.lower()
+        transfer = OutgoingTransfer(next(self.transfer_ids), nick, path, self.get_session_key(nick)[2], self.report)
+        self.transfers_out[transfer.id] = transfer
+        Thread(target=self.stream_file, args=(transfer,), daemon=True).start()
+        return transfer
+
+    def stream_file(self, transfer):
+        try:
+            self.write(transfer.offer())
+            for frame in transfer.frames():
+                self.write(frame)
+        except (OSError, ValueError) as e:
+            self.report("Transfer of {} failed: {}".format(transfer.name, e))
+        finally:
+            self.transfers_out.pop(transfer.id, None)
+
+    def close(self):
+        """
+        Say goodbye, so peers see us leave at once, and stop the receive loop.
+        """
+        if self.sock:
+            try:
+                self.write(encode(COMMAND_LEAVE))
+            except OSError:
+                pass
+        if self.wakeup:
+            try:
+                self.wakeup.send(b"\x00")
+            except OSError:
+                pass
+        if self.thread and self.thread.is_alive():
+            self.thread.join()
+        for sock in (self.sock, self.waiter, self.wakeup):
+            if sock:
+                sock.close()
+        self.sock = self.thread = self.waiter = self.wakeup = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class AsyncSecureChatClient(ClientState):
+    """
+    asyncio client, iterate with async for to receive events.
+    Sending files is only supported by the blocking client.
+    """
+
+    def __init__(self, nick, host='localhost', port=5000, downloads='.', report=print, key_pool=False, ciphers=None):
+        super().__init__(nick, downloads, report, key_pool, ciphers)
+        self.address = (host, port)
+        self.reader = None
+        self.writer = None
+        self.parser = FrameParser()
+        self.pending = [] # Events handled but not yet returned.
+
+    async def connect(self, timeout=10.0):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(*self.address), timeout)
+        self.parser, self.pending = FrameParser(), []
+        params = await asyncio.wait_for(self.receive(), timeout)
+        self.write(self.hello(params))
+        await self.writer.drain()
+        if not self.joined(await asyncio.wait_for(self.receive(), timeout)): # The resume was refused, make a full handshake.
+            self.write(self.hello(params))
+            await self.writer.drain()
+            if not self.joined(await asyncio.wait_for(self.receive(), timeout)):
+                raise ConnectionError("Handshake failed")
+        return self
+
+    def write(self, frame):
+        self.writer.write(frame)
+
+    async def receive(self):
+        """
+        Wait for the next frame, None once the connection is gone.
+        """
+        frame = self.parser.next_frame()
+        while frame is None:
+            data = await self.reader.read(65536)
+            if not data:
+                return None
+            self.parser.feed(data)
+            frame = self.parser.next_frame()
+        return frame
+
+    async def send_message(self, nick, text):
+        self.write(self.encrypt_message(nick, text))
+        await self.writer.drain() # Backpressure, wait while the socket buffer is full.
+
+    async def join_room(self, name):
+        self.write(encode(COMMAND_ROOM_JOIN, recipient=name))
+        await self.writer.drain()
+
+    async def leave_room(self, name):
+        self.rooms.pop(name, None)
+        self.write(encode(COMMAND_ROOM_LEAVE, recipient=name))
+        await self.writer.drain()
+
+    async def send_room_message(self, name, text):
+        self.write(self.encrypt_room_message(name, text))
+        await self.writer.drain()
+
+    async def next_event(self):
+        """
+        Wait for the next event, None once the connection is gone.
+        """
+        while not self.pending:
+            frame = await self.receive()
+            if frame is None:
+                return None
+            self.pending.extend(self.handle(frame))
+        return self.pending.pop(0)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.next_event()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    async def close(self):
+        if self.writer:
+            if not self.writer.is_closing():
+                self.writer.write(encode(COMMAND_LEAVE)) # Peers see us leave at once.
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = self.writer = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
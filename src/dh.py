@@ -2,15 +2,82 @@
 # Diffie-Hellman Key Exchange
 #
 
-from discmath import randprime, primitive_root
+import os
+import sys
+import json
+import random
+import argparse
+from collections import deque
+from threading import Thread, Condition, Lock
+from discmath import randprime, random_prime, safe_prime, primitive_root
 
-def generate_dh_parameters():
+DH_POOL = os.environ.get('SECURECHAT_DH_POOL') # Optional file with pregenerated (q, a) groups.
+DH_MIN_BITS = 13 # Private keys are primes from 2**11 up to q, smaller q may have none.
+DH_SAFE_ABOVE = 64 # Larger q are always safe primes, factoring a random q-1 can take minutes.
+KEY_POOL_TARGET = 64 # Key pairs a pool refills to.
+KEY_POOL_LOW = 16 # Refilling starts below this many pairs.
+KEY_POOLS = {} # Shared pools by group, see get_key_pool.
+KEY_POOLS_LOCK = Lock()
+
+def generate_dh_parameters(bits=None, safe=False):
     """
     Create a common prime number q and find its primitive root a.
+    By default q is an 11-bit to 16-bit prime, otherwise q has exactly bits bits.
+    With safe, q = 2p+1 for a prime p, so q-1 does not need to be factored.
+    Above DH_SAFE_ABOVE bits q is always safe.
     """
-    q = randprime(2**11, 2**16)
+    if safe or (bits or 0) > DH_SAFE_ABOVE:
+        q = safe_prime(bits or 16)
+        return q, primitive_root(q, (2, (q - 1) // 2))
+    q = randprime(2**11, 2**16) if bits is None else random_prime(bits)
     return q, primitive_root(q)
 
+def dh_bits(value):
+    """
+    Argument type for the size of q, at least DH_MIN_BITS.
+    """
+    bits = int(value)
+    if bits < DH_MIN_BITS:
+        raise argparse.ArgumentTypeError("q needs at least {} bits, got {}".format(DH_MIN_BITS, bits))
+    return bits
+
+def load_dh_pool(path):
+    """
+    Read pregenerated groups, a list of (q, a, bits, safe), empty if there is no pool.
+    """
+    try:
+        with open(path, 'r') as f:
+            return [(g['q'], g['a'], g['bits'], g.get('safe', False)) for g in json.load(f)]
+    except (OSError, ValueError, KeyError, TypeError):
+        return []
+
+def save_dh_pool(path, groups):
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump([{'q': q, 'a': a, 'bits': bits, 'safe': safe} for q, a, bits, safe in groups], f, indent=1)
+    os.replace(tmp, path)
+
+def fill_dh_pool(path, count, bits=None, safe=False):
+    """
+    Generate groups until the pool at path holds count groups of the given size, safe ones if safe.
+    """
+    groups = load_dh_pool(path)
+    while len([g for g in groups if g[2] == bits and (g[3] or not safe)]) < count:
+        q, a = generate_dh_parameters(bits, safe)
+        groups.append((q, a, bits, safe or (bits or 0) > DH_SAFE_ABOVE))
+    save_dh_pool(path, groups)
+    return groups
+
+def get_dh_parameters(bits=None, safe=False, path=DH_POOL):
+    """
+    Draw a random group of the requested size from the pool, generate one if there is none.
+    With safe, only safe groups are drawn.
+    """
+    groups = [(q, a) for q, a, size, is_safe in load_dh_pool(path) if size == bits and (is_safe or not safe)] if path else []
+    if groups:
+        return random.choice(groups)
+    return generate_dh_parameters(bits, safe)
+
 def get_private_key(q):
     """
     Find a random prime within a threshold and less than q, return this as the private key.
@@ -28,3 +95,85 @@ def get_shared_key(public_key, private_key, q):
     Given public_key, private_key and shared prime p, compute shared key K.
     """
     return pow(public_key, private_key, q)
+
+class KeyPairPool:
+    """
+    Pregenerated (private, public) key pairs for the group (q, a), so a handshake only pops one.
+    A background thread refills the pool to target once it drops below low, the gap
+    between the two keeps the thread from waking up for every single pair.
+    """
+
+    def __init__(self, q, a, target=KEY_POOL_TARGET, low=KEY_POOL_LOW):
+        self.q, self.a = q, a
+        self.target, self.low = target, min(low, target)
+        self.pairs = deque() # append and popleft are atomic, pop needs no lock.
+        self.condition = Condition()
+        self.closed = False
+        self.misses = 0 # Pops which found the pool empty.
+        self.thread = Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def generate(self):
+        private_key = get_private_key(self.q)
+        return private_key, get_public_key(private_key, self.q, self.a)
+
+    def pop(self):
+        """
+        Take a ready key pair, or make one inline if the pool ran dry.
+        """
+        try:
+            pair = self.pairs.popleft()
+        except IndexError:
+            self.misses += 1
+            pair = self.generate()
+        if len(self.pairs) < self.low:
+            with self.condition:
+                self.condition.notify()
+        return pair
+
+    def prefill(self, n=None):
+        """
+        Fill the pool to n pairs (default, the target) right now, e.g. ahead of an expected burst.
+        A larger n also raises the target.
+        """
+        self.target = max(self.target, n or 0)
+        while len(self.pairs) < self.target:
+            self.pairs.append(self.generate())
+
+    def fill(self):
+        while True:
+            with self.condition:
+                while not self.closed and len(self.pairs) >= self.low:
+                    self.condition.wait()
+                if self.closed:
+                    return
+            while not self.closed and len(self.pairs) < self.target:
+                self.pairs.append(self.generate())
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+def get_key_pool(q, a):
+    """
+    The shared key pair pool for the group (q, a), created on first use.
+    """
+    with KEY_POOLS_LOCK:
+        pool = KEY_POOLS.get((q, a))
+        if pool is None:
+            pool = KEY_POOLS[(q, a)] = KeyPairPool(q, a)
+        return pool
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pregenerate Diffie-Hellman groups')
+    parser.add_argument('pool', help='Pool file, new groups are appended.')
+    parser.add_argument('count', type=int, help='Number of groups the pool should hold for this size.')
+    parser.add_argument('--bits', type=dh_bits, default=None, help='Size of q, default is the 11-bit to 16-bit range.')
+    parser.add_argument('--safe', action='store_true', help='Use safe primes, q = 2p+1.')
+    args = parser.parse_args()
+    groups = fill_dh_pool(args.pool, args.count, args.bits, args.safe)
+    print("{} holds {} groups.".format(args.pool, len(groups)), file=sys.stderr)
@@ -2,82 +2,263 @@
 # Discrete Math Funcs (number theory utility functions)
 #
 
+import os
 import random
 import math
+import mmap
+from array import array
+from itertools import compress
+from bisect import bisect_left, bisect_right
+
+PRIME_LIMIT = 2**17 # Utilize up to 17 bit primes for now.
+PRIME_CACHE = os.environ.get('SECURECHAT_PRIME_CACHE') # Optional file to persist the prime table in.
+
+PRIMES = None # Built on first use, see load_primes.
+PRIMES_N = 0
+BLUM_PRIMES = None # Primes congruent 3 mod 4, used by BBS.
+BLUM_PRIMES_N = 0
 
 def sieve(N):
     """
     Sieve of Eratosthenes algorithm, generate many primes, store
     in memory for faster lookup, etc.
     """
-    v = [True]*N
-    for i in range(2, 1+int(math.sqrt(N)), 1):
+    v = bytearray([1])*N
+    v[:2] = b"\x00\x00"
+    for i in range(2, 1+math.isqrt(N-1)):
         if v[i]:
-            for j in range(i**2,N,i):
-                v[j] = False
-    return [i for i in range(N) if v[i]][2:]
+            v[i*i::i] = bytes(len(range(i*i, N, i))) # Strike out all multiples in one slice assignment.
+    return array('I', compress(range(N), v))
+
+def read_prime_cache(path, N):
+    """
+    Memory-map a prime table written by write_prime_cache, None if it is missing or stale.
+    """
+    try:
+        with open(path, 'rb') as f:
+            table = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast('I')
+    except (OSError, ValueError, TypeError):
+        return None
+    if len(table) < 2 or table[0] != N:
+        return None
+    return table[1:]
+
+def write_prime_cache(path, N, primes):
+    """
+    Store the prime table, prefixed with the sieve limit.
+    """
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        array('I', [N]).tofile(f)
+        primes.tofile(f)
+    os.replace(tmp, path)
+
+def load_primes():
+    """
+    Build the prime tables once, from the cache file if there is one.
+    """
+    global PRIMES, PRIMES_N, BLUM_PRIMES, BLUM_PRIMES_N
+    if PRIMES is not None:
+        return PRIMES
+    primes = read_prime_cache(PRIME_CACHE, PRIME_LIMIT) if PRIME_CACHE else None
+    if primes is None:
+        primes = sieve(PRIME_LIMIT)
+        if PRIME_CACHE:
+            try:
+                write_prime_cache(PRIME_CACHE, PRIME_LIMIT, primes)
+            except OSError:
+                pass # Cache is optional.
+    BLUM_PRIMES = array('I', [p for p in primes if (p % 4) == 3])
+    BLUM_PRIMES_N = len(BLUM_PRIMES)
+    PRIMES_N = len(primes)
+    PRIMES = primes
+    return PRIMES
 
-PRIMES = sieve(2**17) # Utilize up to 17 bit primes for now.
-PRIMES_SET = set(PRIMES)
-PRIMES_N = len(PRIMES)
+SMALL_PRIMES = tuple(sieve(256)) # Trial division before Miller-Rabin.
+MR_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41) # Deterministic for every n < MR_DETERMINISTIC_LIMIT.
+MR_DETERMINISTIC_LIMIT = 3317044064679887385961981
+MR_ROUNDS = 32 # Extra random bases above the limit, error probability < 4**-MR_ROUNDS.
+
+def miller_rabin(n, bases):
+    """
+    Miller-Rabin test of the odd number n > 2, False if any base is a witness for n being composite.
+    """
+    d, r = (n - 1), 0
+    while (d % 2) == 0:
+        d //= 2
+        r += 1
+    for a in bases:
+        x = pow(a, d, n)
+        if x == 1 or x == (n - 1):
+            continue
+        for _ in range(r - 1):
+            x = pow(x, 2, n)
+            if x == (n - 1):
+                break
+        else:
+            return False
+    return True
 
 def is_prime(a):
     """
-    Check if number a is a prime or not, O(sqrt(a)).
-    Fast, check if a has any factors from 2 to sqrt(a), if not = prime.
+    Check if number a is a prime or not, trial division by small primes, then Miller-Rabin.
+    Deterministic below MR_DETERMINISTIC_LIMIT, probabilistic above it.
     """
-    if a == 1:
+    if a < 2:
         return False
-    return (sum([((a % i) == 0) for i in range(2, 1+int(math.sqrt(a)))]) == 0)
+    for p in SMALL_PRIMES:
+        if (a % p) == 0:
+            return a == p
+    if a < (SMALL_PRIMES[-1] ** 2):
+        return True
+    if a < MR_DETERMINISTIC_LIMIT:
+        return miller_rabin(a, MR_BASES)
+    return miller_rabin(a, MR_BASES + tuple(random.randrange(2, a - 1) for _ in range(MR_ROUNDS)))
 
 def nextprime(v):
     """
-    Search for the next prime from v.
+    Search for the next prime from v, O(log n) within the table.
     """
-    v += 1
-    while not v in PRIMES_SET:
-        v += 1
-        if v > PRIMES[PRIMES_N - 1]:
-            return PRIMES[(PRIMES_N // 2)]
+    load_primes()
+    if v < PRIMES[PRIMES_N - 1]:
+        return PRIMES[bisect_right(PRIMES, v)]
+    v = (v + 1) | 1 # Past the table, only test odd numbers.
+    while not is_prime(v):
+        v += 2
     return v
 
 def prevprime(v):
     """
-    Search for the previous prime from v.
+    Search for the previous prime from v, O(log n) within the table.
     """
-    v -= 1
-    while not v in PRIMES_SET:
-        v -= 1
+    load_primes()
+    if v <= (PRIMES[PRIMES_N - 1] + 1):
+        idx = bisect_left(PRIMES, v)
+        if idx == 0:
+            raise ValueError("No prime less than {}".format(v))
+        return PRIMES[idx - 1]
+    v = (v - 2) | 1 # Largest odd number less than v.
+    while not is_prime(v):
+        v -= 2
+    return v
+
+def next_blum_prime(v):
+    """
+    Search for the next prime congruent 3 mod 4 from v, O(log n) within the table.
+    """
+    load_primes()
+    if v < BLUM_PRIMES[BLUM_PRIMES_N - 1]:
+        return BLUM_PRIMES[bisect_right(BLUM_PRIMES, v)]
+    v += (3 - v) % 4 or 4 # Past the table, only test numbers congruent 3 mod 4.
+    while not is_prime(v):
+        v += 4
     return v
 
 def randprime(a, b):
     """
-    Find a random prime within [a,b).
+    Find a random prime within [a,b), uniform over the primes in range.
     """
-    initial = random.randint(a,b-1)
-    min_idx, max_idx = 0, (PRIMES_N-1)
-    
-    while PRIMES[min_idx] < a:
-         min_idx = (min_idx + 1) * 2
+    load_primes()
+    if b <= (PRIMES[PRIMES_N - 1] + 1):
+        min_idx, max_idx = bisect_left(PRIMES, a), bisect_left(PRIMES, b)
+        if min_idx >= max_idx:
+            raise ValueError("No primes within [{}, {})".format(a, b))
+        return PRIMES[random.randrange(min_idx, max_idx)]
+    for _ in range(64 * b.bit_length()): # Rejection sampling, about 1 in ln(b) numbers is a prime.
+        v = random.randrange(a, b)
+        if is_prime(v):
+            return v
+    v = nextprime(max(a, 2) - 1) # Sparse range, fall back to the first prime.
+    if v >= b:
+        raise ValueError("No primes within [{}, {})".format(a, b))
+    return v
 
-    while PRIMES[max_idx] > b:
-        max_idx = (max_idx - 1) // 2
+def random_prime(bits):
+    """
+    Find a random prime of exactly bits bits.
+    """
+    return randprime(2**(bits - 1), 2**bits)
 
-    if min_idx >= max_idx:
-        min_idx = (max_idx - 1)
+def pollard_rho(n):
+    """
+    Find a non-trivial factor of the composite number n, Pollard's rho with Brent's cycle detection.
+    """
+    if (n % 2) == 0:
+        return 2
+    while True:
+        y, c, m = random.randrange(1, n), random.randrange(1, n), 128
+        g, r, q = 1, 1, 1
+        while g == 1:
+            x = y
+            for _ in range(r):
+                y = (y * y + c) % n
+            k = 0
+            while k < r and g == 1:
+                ys = y
+                for _ in range(min(m, r - k)):
+                    y = (y * y + c) % n
+                    q = (q * abs(x - y)) % n
+                g = math.gcd(q, n)
+                k += m
+            r *= 2
+        if g == n:
+            g = 1
+            while g == 1:
+                ys = (ys * ys + c) % n
+                g = math.gcd(abs(x - ys), n)
+        if g != n:
+            return g
 
-    return PRIMES[random.randint(min_idx,max_idx) % PRIMES_N]
+def factorize(n):
+    """
+    Find the distinct prime factors of n, in increasing order.
+    Trial division by the prime table, then Pollard's rho for what is left.
+    """
+    factors = set()
+    for p in load_primes():
+        if (p * p) > n:
+            break
+        if (n % p) == 0:
+            factors.add(p)
+            while (n % p) == 0:
+                n //= p
+    remaining = [n] if n > 1 else []
+    while remaining:
+        v = remaining.pop()
+        if is_prime(v):
+            factors.add(v)
+        else:
+            d = pollard_rho(v)
+            remaining.extend((d, v // d))
+    return sorted(factors)
 
-def primitive_root(a):
+def primitive_root(a, factors=None):
     """
     Find lowest primitive root for prime number a. (primitive root modulo A congruent 1)
+    g is a generator if g^((a-1)/f) != 1 mod a, for every prime factor f of a-1.
+    factors may be given when they are known, e.g. (2, p) for a safe prime a = 2p+1.
     """
-    coprimes = {i for i in range(1, a) if math.gcd(i,a) == 1}
-    for g in range(1, a):
-        if coprimes == {pow(g, powers, a) for powers in range(1, a)}:
+    if a == 2:
+        return 1
+    if not is_prime(a):
+        raise ValueError("{} is not a prime".format(a))
+    exponents = [(a - 1) // f for f in (factors or factorize(a - 1))]
+    for g in range(2, a):
+        if all(pow(g, e, a) != 1 for e in exponents):
             return g # Lowest primitive root which 'generates' 1 to a-1.
     return None # No primitive root.
 
+def safe_prime(bits):
+    """
+    Find a random safe prime q = 2p+1 of exactly bits bits, where p is also a prime.
+    """
+    if bits < 3:
+        raise ValueError("No safe primes with {} bits".format(bits))
+    while True:
+        p = randprime(2**(bits - 2), 2**(bits - 1))
+        if is_prime(2 * p + 1):
+            return 2 * p + 1
+
 if __name__ == "__main__":
     q = randprime(2**11, 2**16)
     print("Prime {}, primitive root {}".format(q, primitive_root(q)))
@@ -0,0 +1,203 @@
+#
+# Load generator, simulated clients against a running chat server
+#
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+from client import AsyncSecureChatClient, EVENT_JOIN, EVENT_MESSAGE
+from dh import get_key_pool
+
+PATTERNS = ('one-to-one', 'hot', 'storm')
+
+def percentile(values, p):
+    """
+    Nearest rank percentile of sorted values, None if there are none.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+def summary(values):
+    """
+    Count, mean and tail percentiles, values are in seconds and reported in milliseconds.
+    """
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        'count': len(values),
+        'mean': ms(sum(values) / len(values)),
+        'p50': ms(percentile(values, 50)),
+        'p99': ms(percentile(values, 99)),
+        'p999': ms(percentile(values, 99.9)),
+        'max': ms(values[-1]),
+    }
+
+def cpu_time(pids):
+    """
+    User plus system CPU seconds used by the processes so far, read from /proc.
+    """
+    total = 0
+    for pid in pids:
+        try:
+            with open("/proc/{}/stat".format(pid), 'r') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += int(fields[11]) + int(fields[12]) # utime and stime, in clock ticks.
+        except (OSError, IndexError, ValueError):
+            pass
+    return total / os.sysconf('SC_CLK_TCK')
+
+def raise_fd_limit():
+    """
+    Thousands of clients need as many sockets, use the hard limit.
+    """
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def targets(pattern, i, n):
+    """
+    Recipient of client i.
+    """
+    if pattern == 'hot':
+        return 0 if i else 1
+    return (i ^ 1) if (i ^ 1) < n else 0
+
+class LoadClient:
+    """
+    One simulated user, records handshake time, roster convergence and message latency.
+    """
+
+    def __init__(self, index, nick, args, stats):
+        self.index = index
+        self.client = AsyncSecureChatClient(nick, args.host, args.port, report=lambda *a: None, key_pool=not args.no_key_pool)
+        self.stats = stats
+        self.expected = args.clients - 1 # Peers we should learn about.
+        self.converged = asyncio.Event()
+        self.started = None
+
+    async def connect(self):
+        self.started = time.perf_counter()
+        await self.client.connect()
+        self.stats['handshake'].append(time.perf_counter() - self.started)
+        if self.expected == 0:
+            self.converged.set()
+
+    async def receive(self):
+        async for event in self.client:
+            if event.type == EVENT_JOIN and len(self.client.keys) >= self.expected and not self.converged.is_set():
+                self.stats['roster'].append(time.perf_counter() - self.started)
+                self.converged.set()
+            elif event.type == EVENT_MESSAGE:
+                sent = int(event.data.split(' ', 1)[0])
+                self.stats['latency'].append((time.perf_counter_ns() - sent) / 1e9)
+                self.stats['received'] += 1
+
+    async def send(self, recipient, count, rate, size):
+        delay = (1.0 / rate) if rate else 0
+        padding = "x" * max(0, size - 20)
+        for _ in range(count):
+            await self.client.send_message(recipient, "{} {}".format(time.perf_counter_ns(), padding))
+            self.stats['sent'] += 1
+            if delay:
+                await asyncio.sleep(delay)
+
+async def run(args):
+    stats = {'handshake': [], 'roster': [], 'latency': [], 'sent': 0, 'received': 0, 'failed': 0}
+    prefix = "lg{}x".format(os.getpid() % 10000) # Unique nicks per run.
+    clients = [LoadClient(i, "{}{}".format(prefix, i), args, stats) for i in range(args.clients)]
+    limit = asyncio.Semaphore(args.clients if args.pattern == 'storm' else args.concurrency)
+
+    async def connect(c):
+        async with limit:
+            try:
+                await c.connect()
+            except (OSError, ConnectionError, asyncio.TimeoutError):
+                stats['failed'] += 1
+                return
+        receivers.append(asyncio.ensure_future(c.receive()))
+
+    if not args.no_key_pool: # Key pairs are made before the clock starts, handshakes measure the server.
+        probe = await AsyncSecureChatClient(prefix + "probe", args.host, args.port, report=lambda *a: None, key_pool=True).connect()
+        await probe.close()
+        get_key_pool(*probe.params).prefill(args.clients)
+
+    receivers = []
+    cpu_start, wall_start = cpu_time(args.server_pid), time.perf_counter()
+    await asyncio.gather(*(connect(c) for c in clients))
+    connected = [c for c in clients if c.client.writer is not None]
+    try:
+        await asyncio.wait_for(asyncio.gather(*(c.converged.wait() for c in connected)), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    join_time = time.perf_counter() - wall_start
+
+    send_start = time.perf_counter()
+    count = 1 if args.pattern == 'storm' else args.messages
+    senders = []
+    for c in connected:
+        recipient = clients[targets(args.pattern, c.index, args.clients)].client.nick
+        if recipient in c.client.keys:
+            senders.append(c.send(recipient, count, args.rate, args.size))
+    await asyncio.gather(*senders, return_exceptions=True)
+    deadline = time.perf_counter() + args.timeout
+    while stats['received'] < stats['sent'] and time.perf_counter() < deadline: # Wait for delivery, or give up on lost messages.
+        await asyncio.sleep(0.05)
+    send_time = time.perf_counter() - send_start
+    cpu = cpu_time(args.server_pid) - cpu_start
+    wall = time.perf_counter() - wall_start
+
+    for c in connected:
+        await c.client.close()
+    await asyncio.gather(*receivers, return_exceptions=True)
+    return {
+        'pattern': args.pattern,
+        'clients': args.clients,
+        'connected': len(connected),
+        'failed': stats['failed'],
+        'sent': stats['sent'],
+        'received': stats['received'],
+        'lost': stats['sent'] - stats['received'],
+        'messages_per_sec': round(stats['received'] / send_time, 1) if send_time else None,
+        'join_seconds': round(join_time, 3),
+        'handshake_ms': summary(stats['handshake']),
+        'roster_ms': summary(stats['roster']),
+        'latency_ms': summary(stats['latency']),
+        'server_cpu_seconds': round(cpu, 3) if args.server_pid else None,
+        'server_cpu_percent': round(100 * cpu / wall, 1) if args.server_pid and wall else None,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load generator for the Secure Chat Server')
+    parser.add_argument('port', type=int, nargs='?', default=5000)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--clients', type=int, default=100, help='Number of simulated clients.')
+    parser.add_argument('--pattern', choices=PATTERNS, default='one-to-one', help='one-to-one pairs, hot sends everything to one client, storm connects everyone at once.')
+    parser.add_argument('--messages', type=int, default=10, help='Messages per client.')
+    parser.add_argument('--rate', type=float, default=0, help='Messages per second per client, 0 for as fast as possible.')
+    parser.add_argument('--size', type=int, default=32, help='Message size in bytes.')
+    parser.add_argument('--concurrency', type=int, default=64, help='Handshakes in flight at once, storm ignores it.')
+    parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for the roster and for delivery.')
+    parser.add_argument('--no-key-pool', action='store_true', help='Make every key pair during the handshake instead of taking a pregenerated one.')
+    parser.add_argument('--server-pid', type=int, action='append', default=[], help='Server process to measure CPU of, repeat for workers.')
+    parser.add_argument('--label', default=None, help='Name of this run, e.g. the version under test.')
+    parser.add_argument('--output', default=None, help='Append the results as a JSON line to this file.')
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    result = asyncio.run(run(args))
+    result.update({'label': args.label, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'rate': args.rate, 'size': args.size, 'messages': args.messages})
+    print(json.dumps(result, indent=1))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result) + "\n")
+    sys.exit(0 if result['connected'] else 1)
@@ -0,0 +1,218 @@
+#
+# Server metrics, counters, gauges and histograms, exposed over a small HTTP admin port
+#
+
+import json
+import socket
+import selectors
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0) # Seconds.
+MAX_REQUEST = 8192 # Admin requests are a single small GET.
+
+class Counter:
+    """
+    Value which only goes up, inc is a single addition.
+    """
+    __slots__ = ('name', 'help', 'value')
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name, self.help, self.value = name, help, 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def get(self):
+        return self.value
+
+class Gauge:
+    """
+    Value which goes up and down, either set directly or read from func when scraped.
+    """
+    __slots__ = ('name', 'help', 'value', 'func')
+    type = 'gauge'
+
+    def __init__(self, name, help, func=None):
+        self.name, self.help, self.value, self.func = name, help, 0, func
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.func() if self.func else self.value
+
+class Histogram:
+    """
+    Observations counted in fixed buckets, with their sum, observe is a bisect and two additions.
+    """
+    __slots__ = ('name', 'help', 'buckets', 'counts', 'sum', 'count')
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name, self.help = name, help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # The last one is +Inf.
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get(self):
+        """
+        Cumulative bucket counts, as Prometheus expects them.
+        """
+        total, buckets = 0, {}
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            buckets['+Inf' if bound == float('inf') else repr(bound)] = total
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+class Metrics:
+    """
+    A set of named metrics with the same constant labels, e.g. the worker id.
+    """
+
+    def __init__(self, prefix='securechat', labels=None):
+        self.prefix = prefix
+        self.labels = dict(labels or {})
+        self.metrics = []
+
+    def add(self, metric):
+        metric.name = "{}_{}".format(self.prefix, metric.name)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help, func=None):
+        return self.add(Gauge(name, help, func))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def format_labels(self, extra=None):
+        labels = dict(self.labels, **(extra or {}))
+        if not labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels.items()) + "}"
+
+    def prometheus(self):
+        """
+        Prometheus text exposition format.
+        """
+        lines = []
+        for m in self.metrics:
+            lines.append("# HELP {} {}".format(m.name, m.help))
+            lines.append("# TYPE {} {}".format(m.name, m.type))
+            if m.type == 'histogram':
+                value = m.get()
+                for bound, n in value['buckets'].items():
+                    lines.append("{}_bucket{} {}".format(m.name, self.format_labels({'le': bound}), n))
+                lines.append("{}_sum{} {}".format(m.name, self.format_labels(), value['sum']))
+                lines.append("{}_count{} {}".format(m.name, self.format_labels(), value['count']))
+            else:
+                lines.append("{}{} {}".format(m.name, self.format_labels(), m.get()))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        All current values, keyed by metric name without the prefix.
+        """
+        values = {m.name[(len(self.prefix) + 1):]: m.get() for m in self.metrics}
+        values.update(self.labels)
+        return values
+
+class AdminServer:
+    """
+    Minimal HTTP endpoint on the server's selector, GET /metrics for Prometheus, GET /stats for JSON.
+    Every request gets one response and the connection is closed. Responses are written as the
+    socket accepts them, a slow scraper never blocks the chat server's loop.
+    """
+
+    def __init__(self, metrics, port, host='localhost'):
+        self.metrics = metrics
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+        self.requests = {} # Partial requests by connection.
+        self.responses = {} # Unsent rest of the response by connection.
+
+    def register(self, selector):
+        """
+        Selector events for the admin sockets carry this object as data, pass them to on_event.
+        """
+        self.selector = selector
+        selector.register(self.sock, selectors.EVENT_READ, self)
+
+    def on_event(self, sock):
+        if sock in self.responses:
+            self.write(sock)
+            return
+        if sock is self.sock:
+            try:
+                conn, _ = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            conn.setblocking(False)
+            self.requests[conn] = b""
+            self.selector.register(conn, selectors.EVENT_READ, self)
+            return
+        try:
+            data = sock.recv(MAX_REQUEST)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        request = self.requests.get(sock, b"") + data
+        if data and b"\r\n\r\n" not in request and len(request) < MAX_REQUEST:
+            self.requests[sock] = request
+            return
+        if not data:
+            self.close(sock)
+            return
+        self.requests.pop(sock, None)
+        self.responses[sock] = memoryview(self.respond(request))
+        self.selector.modify(sock, selectors.EVENT_WRITE, self)
+        self.write(sock)
+
+    def respond(self, request):
+        path = request.split(b"\r\n", 1)[0].split(b" ")[1:2]
+        path = path[0].decode('latin-1').split('?')[0] if path else ""
+        if path == '/metrics':
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4", self.metrics.prometheus()
+        elif path in ('/stats', '/metrics.json'):
+            status, content_type, body = "200 OK", "application/json", json.dumps(self.metrics.snapshot())
+        else:
+            status, content_type, body = "404 Not Found", "text/plain", "Try /metrics or /stats\n"
+        body = body.encode('utf-8')
+        head = "HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(status, content_type, len(body))
+        return head.encode('latin-1') + body
+
+    def write(self, sock):
+        """
+        Send what the socket takes without blocking, close once the response is out.
+        """
+        response = self.responses[sock]
+        try:
+            sent = sock.send(response)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            sent = len(response)
+        if sent < len(response):
+            self.responses[sock] = response[sent:]
+            return
+        self.close(sock)
+
+    def close(self, sock):
+        self.requests.pop(sock, None)
+        self.responses.pop(sock, None)
+        self.selector.unregister(sock)
+        sock.close()
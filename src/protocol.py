@@ -0,0 +1,171 @@
+#
+# Wire protocol, length-prefixed binary frames
+#
+# Every frame is a header followed by a body:
+#   length (uint32, size of the body), type (uint8), sender length (uint8), recipient length (uint8)
+#   body = sender + recipient + payload
+#
+
+import struct
+from collections import namedtuple
+
+COMMAND_CONNECT = 1 # Server -> client, roster entries "nick:key,nick:key" in the payload. Replaced by COMMAND_ROSTER.
+COMMAND_DISCONNECT = 2 # Server -> client, sender left the chat. Replaced by COMMAND_ROSTER.
+COMMAND_MESSAGE = 3 # Client -> server to recipient, server -> client from sender. Payload is the cipher suite (uint8) and ciphertext.
+COMMAND_PARAMS = 4 # Server -> client, Diffie-Hellman parameters, the cipher suites allowed, most preferred first, the server's public key and a nonce (hex) for this connection, "q,a;suites;key,nonce".
+COMMAND_HELLO = 5 # Client -> server, sender is the nick and the payload the public key, optionally ",epoch,version" of a roster to resume, then ";suites" the client can run.
+COMMAND_FILE_OFFER = 6 # Client -> client, a file transfer starts, see transfer.py.
+COMMAND_FILE_CHUNK = 7 # Client -> client, encrypted part of a file.
+COMMAND_FILE_ACK = 8 # Client -> client, bytes received so far, opens the sender's window.
+COMMAND_FILE_CANCEL = 9 # Client -> client, either side aborts the transfer.
+COMMAND_BUS_JOIN = 10 # Worker -> worker, sender joined on the sending worker, the payload is the public key.
+COMMAND_BUS_LEAVE = 11 # Worker -> worker, sender left the sending worker.
+COMMAND_ROSTER = 12 # Server -> client, versioned roster snapshot page or delta, see roster.py.
+COMMAND_ROOM_JOIN = 13 # Client -> server, join the room named by recipient. Server -> client and worker -> worker, sender joined the room, the payload is the join stamp.
+COMMAND_ROOM_LEAVE = 14 # Client -> server, leave the room. Server -> client, sender left the room.
+COMMAND_ROOM_MEMBERS = 15 # Server -> client, members of the room with their join stamps "nick:stamp,nick:stamp", the earliest one is the owner.
+COMMAND_ROOM_MESSAGE = 16 # Client -> server -> members, key epoch (uint32) and ciphertext under the room key.
+COMMAND_ROOM_KEY = 17 # Client -> client, room key encrypted under the pairwise key, see client.py.
+COMMAND_TICKET = 18 # Server -> client, resumption ticket for this session, see tickets.py.
+COMMAND_RESUME = 19 # Client -> server instead of HELLO, roster epoch and version (RESUME), the proof and the ticket, see tickets.py. Server -> client, resume refused, send HELLO.
+COMMAND_LEAVE = 20 # Client -> server, the user quits, peers are told at once instead of after the resume grace period.
+COMMAND_REJECT = 21 # Server -> client, the handshake was refused, the payload is the reason. The server closes the connection.
+
+ROUTED = {COMMAND_MESSAGE, COMMAND_FILE_OFFER, COMMAND_FILE_CHUNK, COMMAND_FILE_ACK, COMMAND_FILE_CANCEL, COMMAND_ROOM_KEY} # Relayed by the server to the recipient.
+
+CONTROL = {COMMAND_PARAMS, COMMAND_ROSTER, COMMAND_TICKET, COMMAND_RESUME, COMMAND_REJECT, COMMAND_ROOM_JOIN, COMMAND_ROOM_LEAVE, COMMAND_ROOM_MEMBERS} # Server state a client can not recover if it misses one, a slow consumer is closed rather than lose one.
+
+ROOM_COMMANDS = {COMMAND_ROOM_JOIN, COMMAND_ROOM_LEAVE, COMMAND_ROOM_MESSAGE} # Handled by the server's room index.
+
+CIPHER_SDES = 1 # Cipher suite ids, see ciphers.py. Lists of them are sent as "1+3".
+CIPHER_AES = 2
+CIPHER_SHAKE = 3
+CIPHER_NAMES = {CIPHER_SDES: 'sdes', CIPHER_AES: 'aes-128-ctr', CIPHER_SHAKE: 'shake256'}
+CIPHER_PREFERENCE = (CIPHER_AES, CIPHER_SHAKE, CIPHER_SDES) # Default order the server offers. S-DES is fastest for short messages but has a 10-bit key, see bench.py.
+
+HEADER = struct.Struct('!IBBB')
+RESUME = struct.Struct('!qq') # Roster epoch and version to resume from, -1 for none.
+MAX_FRAME = 16 * 1024 * 1024 # Largest body we accept.
+BUFFER = 4096 # Initial receive buffer, it grows to fit larger frames.
+
+Frame = namedtuple('Frame', ['type', 'sender', 'recipient', 'payload'])
+
+class ProtocolError(ValueError):
+    pass
+
+def encode(type, payload=b"", sender="", recipient=""):
+    """
+    Build a frame, sender and recipient are nicknames.
+    """
+    sender, recipient = sender.encode('utf-8'), recipient.encode('utf-8')
+    if len(sender) > 255 or len(recipient) > 255:
+        raise ProtocolError("Nickname too long")
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    length = len(sender) + len(recipient) + len(payload)
+    return b"".join((HEADER.pack(length, type, len(sender), len(recipient)), sender, recipient, payload))
+
+def encode_into(type, size, sender="", recipient=""):
+    """
+    Build a frame with room for a payload of size bytes, returns the frame and a writable view of the payload.
+    Ciphertext can be written straight into the frame instead of being joined to the header afterwards.
+    """
+    head = encode(type, b"", sender, recipient)
+    length, _, sender_len, recipient_len = HEADER.unpack_from(head)
+    frame = bytearray(len(head) + size)
+    frame[:len(head)] = head
+    HEADER.pack_into(frame, 0, length + size, type, sender_len, recipient_len)
+    return frame, memoryview(frame)[len(head):]
+
+def parse_suites(text):
+    """
+    Known cipher suite ids from "1+3", in the order given, unknown ones are skipped.
+    """
+    suites = []
+    for v in text.split('+'):
+        if v.isdigit() and int(v) in CIPHER_NAMES and int(v) not in suites:
+            suites.append(int(v))
+    return suites
+
+def cipher_id(name):
+    """
+    Cipher suite id from its name, ValueError for unknown names.
+    """
+    for suite_id, suite_name in CIPHER_NAMES.items():
+        if suite_name == name:
+            return suite_id
+    raise ValueError("Unknown cipher suite {}, choose from {}".format(name, ", ".join(CIPHER_NAMES.values())))
+
+def format_suites(suites):
+    return "+".join(str(v) for v in suites)
+
+class FrameParser:
+    """
+    Incremental frame parser over a reusable receive buffer.
+    Bytes are received straight into the buffer, complete frames are cut out of it,
+    partial frames stay until the rest arrives.
+    """
+
+    def __init__(self, size=BUFFER):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # First unparsed byte.
+        self.end = 0 # End of received data.
+
+    def reserve(self, n):
+        """
+        Make room for n more bytes, move pending data to the front or grow the buffer.
+        """
+        if (len(self.buffer) - self.end) >= n:
+            return
+        pending = (self.end - self.start)
+        if self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end] # Same size, allowed while the view is exported.
+            self.start, self.end = 0, pending
+        if (len(self.buffer) - self.end) < n:
+            self.view.release()
+            self.buffer.extend(bytes(n - (len(self.buffer) - self.end)))
+            self.view = memoryview(self.buffer)
+
+    def recv_into(self, sock, n=None):
+        """
+        Receive up to n bytes (default, all free space) from sock into the buffer, returns the number of bytes, 0 on EOF.
+        """
+        self.reserve(n or (BUFFER // 2))
+        received = sock.recv_into(self.view[self.end:(self.end + n) if n else None])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        self.reserve(len(data))
+        self.view[self.end:(self.end + len(data))] = data
+        self.end += len(data)
+
+    def next_frame(self):
+        """
+        Cut the next complete frame out of the buffer, None if there is none yet.
+        """
+        available = (self.end - self.start)
+        if available < HEADER.size:
+            return None
+        length, type, sender_len, recipient_len = HEADER.unpack_from(self.buffer, self.start)
+        if length > MAX_FRAME or (sender_len + recipient_len) > length:
+            raise ProtocolError("Bad frame header")
+        if available < (HEADER.size + length):
+            return None
+        i = (self.start + HEADER.size)
+        j = (i + sender_len)
+        k = (j + recipient_len)
+        end = (i + length)
+        frame = Frame(type, str(self.view[i:j], 'utf-8'), str(self.view[j:k], 'utf-8'), bytes(self.view[k:end]))
+        self.start = end
+        if self.start == self.end:
+            self.start = self.end = 0
+        return frame
+
+    def __iter__(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
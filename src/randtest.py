@@ -0,0 +1,128 @@
+#
+# Statistical randomness tests (NIST SP 800-22 style), vectorized over packed bit arrays
+#
+
+import math
+import numpy as np
+
+def igamc(a, x):
+    """
+    Regularized upper incomplete gamma function Q(a, x), used for chi-square p-values.
+    Series expansion below a+1, continued fraction above (Numerical Recipes).
+    """
+    if x <= 0:
+        return 1.0
+    gln = math.lgamma(a)
+    if x < (a + 1):
+        ap, total = a, (1.0 / a)
+        delta = total
+        for _ in range(1000):
+            ap += 1
+            delta *= (x / ap)
+            total += delta
+            if abs(delta) < (abs(total) * 1e-15):
+                break
+        return max(0.0, 1.0 - total * math.exp(-x + a * math.log(x) - gln))
+    b = (x + 1 - a)
+    c, d = 1e300, (1.0 / b)
+    h = d
+    for i in range(1, 1000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = 1e-300 if abs(d) < 1e-300 else d
+        c = b + an / c
+        c = 1e-300 if abs(c) < 1e-300 else c
+        d = (1.0 / d)
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return math.exp(-x + a * math.log(x) - gln) * h
+
+def unpack(data, nbits=None):
+    """
+    Bytes or packed uint8 array to an array of 0/1 values, most significant bit first.
+    """
+    bits = np.unpackbits(np.frombuffer(bytes(data), dtype=np.uint8) if not isinstance(data, np.ndarray) else data)
+    return (bits if nbits is None else bits[:nbits])
+
+def monobit(bits):
+    """
+    Frequency test, the number of ones and zeros should be about the same.
+    """
+    n = len(bits)
+    s = abs(2 * int(np.count_nonzero(bits)) - n)
+    return math.erfc(s / math.sqrt(2 * n))
+
+def runs(bits):
+    """
+    Runs test, the number of uninterrupted runs of equal bits should match a random sequence.
+    """
+    n = len(bits)
+    pi = np.count_nonzero(bits) / n
+    if abs(pi - 0.5) >= (2 / math.sqrt(n)): # Frequency test prerequisite failed.
+        return 0.0
+    v = 1 + int(np.count_nonzero(bits[1:] != bits[:-1]))
+    return math.erfc(abs(v - 2 * n * pi * (1 - pi)) / (2 * math.sqrt(2 * n) * pi * (1 - pi)))
+
+def block_frequency(bits, M=128):
+    """
+    Frequency test within blocks of M bits.
+    """
+    N = len(bits) // M
+    if N == 0:
+        return None
+    pi = bits[:N * M].reshape(N, M).mean(axis=1)
+    chi2 = 4 * M * float(np.sum((pi - 0.5) ** 2))
+    return igamc(N / 2, chi2 / 2)
+
+def psi2(bits, m):
+    """
+    Serial test statistic, frequencies of all overlapping m-bit patterns (wrapping around).
+    """
+    if m <= 0:
+        return 0.0
+    n = len(bits)
+    extended = np.concatenate((bits, bits[:m - 1])).astype(np.int64)
+    patterns = np.zeros(n, dtype=np.int64)
+    for i in range(m):
+        patterns = (patterns << 1) | extended[i:i + n]
+    counts = np.bincount(patterns, minlength=2**m)
+    return ((2**m) / n) * float(np.sum(counts.astype(np.float64) ** 2)) - n
+
+def serial(bits, m=3):
+    """
+    Serial test, every m-bit pattern should be equally likely. Returns both p-values.
+    """
+    p0, p1, p2 = psi2(bits, m), psi2(bits, m - 1), psi2(bits, m - 2)
+    d1, d2 = (p0 - p1), (p0 - 2 * p1 + p2)
+    return igamc(2**(m - 2), d1 / 2), igamc(2**(m - 3), d2 / 2)
+
+def chi_square(data):
+    """
+    Chi-square goodness of fit of the byte values against the uniform distribution.
+    """
+    values = np.frombuffer(bytes(data), dtype=np.uint8) if not isinstance(data, np.ndarray) else data
+    if len(values) == 0:
+        return None
+    expected = len(values) / 256
+    chi2 = float(np.sum((np.bincount(values, minlength=256) - expected) ** 2) / expected)
+    return igamc(255 / 2, chi2 / 2)
+
+def run_tests(data, nbits=None):
+    """
+    Run the whole battery over packed data, return the test names linked to their p-values.
+    A p-value below 0.01 means the sequence is likely not random.
+    """
+    bits = unpack(data, nbits)
+    serial1, serial2 = serial(bits)
+    results = {
+        'monobit': monobit(bits),
+        'runs': runs(bits),
+        'block_frequency': block_frequency(bits),
+        'serial_1': serial1,
+        'serial_2': serial2,
+        'chi_square': chi_square(np.packbits(bits[:(len(bits) // 8) * 8])),
+    }
+    return results
@@ -0,0 +1,118 @@
+#
+# Versioned roster, snapshots, delta log and batched change fan-out
+#
+# A roster frame payload is a header and the entries, "epoch,version,kind[,page,pages];entries".
+# kind S is a snapshot page, the first page replaces the roster and the last one completes it.
+# kind D is a delta. Entries are "nick:key:suites" for users who joined, "nick:" for users who left.
+# The server keeps "key:suites" as a single string, suites are the cipher suites the user can run.
+#
+
+import os
+import time
+from collections import deque
+from protocol import encode, parse_suites, COMMAND_ROSTER
+
+ROSTER_PAGE = 256 # Entries per snapshot frame.
+ROSTER_LOG = 4096 # Changes kept to resume from.
+ROSTER_BATCH = 0.05 # Seconds joins and leaves are gathered before they are sent out.
+
+def format_entries(entries):
+    return ",".join("{}:{}".format(nick, key if key is not None else "") for nick, key in entries)
+
+def parse_roster(payload):
+    """
+    Split a roster payload into (epoch, version, kind, page, pages, entries). Entries are (nick, key, suites),
+    the key is None for users who left.
+    """
+    header, _, body = payload.decode('utf-8').partition(';') # Nicks may be any UTF-8 text.
+    fields = header.split(',')
+    epoch, version, kind = int(fields[0]), int(fields[1]), fields[2]
+    page, pages = (int(fields[3]), int(fields[4])) if kind == 'S' else (0, 1)
+    entries = []
+    for entry in (body.split(',') if body else []):
+        nick, key, suites = (entry.split(':') + [""])[:3]
+        entries.append((nick, int(key), parse_suites(suites)) if key else (nick, None, None))
+    return epoch, version, kind, page, pages, entries
+
+class Roster:
+    """
+    Every user known to this server process, with a version which grows on each change.
+    The epoch is random per process, versions of another process can not be resumed.
+    """
+
+    def __init__(self, epoch=None):
+        self.epoch = epoch if epoch is not None else int.from_bytes(os.urandom(4), 'big')
+        self.version = 0
+        self.users = {} # nick -> public key and suites.
+        self.log = deque(maxlen=ROSTER_LOG) # (version, nick, key), key is None for a leave.
+        self.pending = {} # Changes not sent yet, the last one per nick.
+        self.deadline = None # When pending changes are sent.
+
+    def __len__(self):
+        return len(self.users)
+
+    def change(self, nick, key):
+        """
+        A user joined (key) or left (None), the change is sent with the next batch.
+        """
+        if key is None:
+            if self.users.pop(nick, None) is None:
+                return
+        else:
+            self.users[nick] = key
+        self.version += 1
+        self.log.append((self.version, nick, key))
+        self.pending[nick] = key
+        self.schedule()
+
+    def schedule(self):
+        """
+        Make sure a batch goes out within ROSTER_BATCH, even without changes.
+        """
+        if self.deadline is None:
+            self.deadline = time.monotonic() + ROSTER_BATCH
+
+    def timeout(self):
+        """
+        Seconds until pending changes are due, None if there are none.
+        """
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def flush(self):
+        """
+        Encode the pending changes as a single delta frame, None if there is nothing to send.
+        """
+        self.deadline = None
+        if not self.pending:
+            return None
+        frame = self.delta(self.pending.items())
+        self.pending = {}
+        return frame
+
+    def delta(self, entries):
+        return encode(COMMAND_ROSTER, "{},{},D;{}".format(self.epoch, self.version, format_entries(entries)))
+
+    def snapshot(self, excluded=None):
+        """
+        The whole roster as frames of up to ROSTER_PAGE entries, always at least one frame.
+        Without excluded, the frames can be shared by every new client, they skip their own nick.
+        """
+        entries = [(nick, key) for nick, key in self.users.items() if nick != excluded]
+        pages = max(1, (len(entries) + ROSTER_PAGE - 1) // ROSTER_PAGE)
+        return [encode(COMMAND_ROSTER, "{},{},S,{},{};{}".format(self.epoch, self.version, i, pages, format_entries(entries[(i * ROSTER_PAGE):((i + 1) * ROSTER_PAGE)]))) for i in range(pages)]
+
+    def resume(self, epoch, version, excluded=None):
+        """
+        Frames which bring a client at (epoch, version) up to date, the changes since then
+        if they are still in the log, a snapshot otherwise.
+        """
+        if epoch == self.epoch and 0 <= version <= self.version:
+            if version == self.version:
+                return [self.delta(())]
+            if self.log and self.log[0][0] <= (version + 1):
+                changes = {}
+                for v, nick, key in self.log:
+                    if v > version and nick != excluded:
+                        changes[nick] = key
+                return [self.delta(changes.items())]
+        return self.snapshot(excluded)
@@ -2,7 +2,10 @@
 # Simple DES implementation
 #
 
+import os
 import numpy as np
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 
 MASK_BIT_0 = 0x000
 MASK_BIT_1 = 0x001
@@ -20,6 +23,11 @@ MASK_BIT_ALL_5 = 0x001F
 MASK_BIT_ALL_8 = 0x0FF
 MASK_BIT_ALL_10 = 0x3FF
 
+NONCE_SIZE = 8 # Bytes, sent in front of CTR ciphertext.
+CTR_BLOCK = 8 # Counter blocks are 64-bit, enciphered a byte at a time.
+CTR_PARALLEL_THRESHOLD = 1 << 24 # Payloads from this size (16MB) are split over worker processes.
+CTR_CHUNK = 1 << 22 # Bytes per worker job, a multiple of CTR_BLOCK.
+
 S0 = np.array([
     [1,0,3,2],
     [3,2,1,0],
@@ -142,3 +150,120 @@ def encrypt_sdes(plaintext, key):
 def decrypt_sdes(ciphertext, key):
     key1, key2 = get_subkey(key)    
     return "".join([chr(get_inv_ip(FK(SW(FK(get_ip(int(ciphertext[i:(i+8)],2)),key2)),key1))) for i in range(0, len(ciphertext), 8)])
+
+def encrypt_block(v, key1, key2):
+    """
+    Encrypt a single 8-bit block, given the subkeys.
+    """
+    return get_inv_ip(FK(SW(FK(get_ip(v),key1)),key2))
+
+def decrypt_block(v, key1, key2):
+    """
+    Decrypt a single 8-bit block, given the subkeys.
+    """
+    return get_inv_ip(FK(SW(FK(get_ip(v),key2)),key1))
+
+@lru_cache(maxsize=1024)
+def get_tables(key):
+    """
+    Build the full encryption and decryption lookup tables for key.
+    S-DES only has 256 possible blocks, so every block is computed once per key,
+    the cache holds all 1024 possible keys at most.
+    """
+    key1, key2 = get_subkey(key)
+    encr = np.array([encrypt_block(v, key1, key2) for v in range(256)], dtype=np.uint8)
+    decr = np.empty(256, dtype=np.uint8)
+    decr[encr] = np.arange(256, dtype=np.uint8) # S-DES is a permutation of the 256 blocks.
+    encr.flags.writeable = False
+    decr.flags.writeable = False
+    return encr, decr
+
+def as_buffer(data):
+    """
+    View text, bytes or a uint8 array as a uint8 array, without copying when possible.
+    Text is encoded as UTF-8, like everywhere else in this module and on the wire.
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if isinstance(data, np.ndarray):
+        return data.view(np.uint8).reshape(-1)
+    return np.frombuffer(data, dtype=np.uint8)
+
+def apply_table(table, data):
+    """
+    Substitute every byte in data, using an encryption or decryption table.
+    """
+    return table[as_buffer(data)].tobytes()
+
+def encrypt_bytes(data, key):
+    """
+    Encrypt a whole buffer at once, using the table for key.
+    """
+    return apply_table(get_tables(key)[0], data)
+
+def decrypt_bytes(data, key):
+    """
+    Decrypt a whole buffer at once, using the table for key.
+    """
+    return apply_table(get_tables(key)[1], data)
+
+def ctr_keystream(key, nonce, offset, n):
+    """
+    S-DES counter mode keystream, bytes [offset, offset+n) for the 64-bit nonce.
+    Counter block i is nonce+i, each byte is enciphered chained to the previous one,
+    forwards then backwards, so every keystream byte depends on the whole counter.
+    """
+    encr = get_tables(key)[0]
+    first, last = (offset // CTR_BLOCK), ((offset + n + CTR_BLOCK - 1) // CTR_BLOCK)
+    counters = np.arange(first, last, dtype=np.uint64) + np.uint64(nonce) # Wraps around modulo 2^64.
+    blocks = counters.astype('>u8').view(np.uint8).reshape(-1, CTR_BLOCK).copy()
+    for i in range(CTR_BLOCK):
+        blocks[:, i] = encr[blocks[:, i] ^ blocks[:, i - 1]] if i else encr[blocks[:, i]]
+    for i in range(CTR_BLOCK - 2, -1, -1):
+        blocks[:, i] = encr[blocks[:, i] ^ blocks[:, i + 1]]
+    start = offset - (first * CTR_BLOCK)
+    return blocks.reshape(-1)[start:(start + n)]
+
+def bbs_keystream(key, nonce, n):
+    """
+    Blum Blum Shub keystream for the key and nonce, it can only be generated serially.
+    """
+    from bbs import BlumBlumShub
+    return np.frombuffer(BlumBlumShub((nonce << 10) | key | (1 << 74)).read(n), dtype=np.uint8)
+
+def ctr_xor(args):
+    """
+    XOR a chunk starting at offset with the keystream. Runs in the worker processes for large payloads.
+    """
+    key, nonce, offset, chunk = args
+    data = as_buffer(chunk)
+    return (data ^ ctr_keystream(key, nonce, offset, len(data))).tobytes()
+
+def ctr_transform(data, key, nonce, keystream='sdes', offset=0, workers=None):
+    """
+    Encryption and decryption are the same in CTR mode, XOR with the keystream.
+    """
+    data = memoryview(data.encode('utf-8') if isinstance(data, str) else data).cast('B')
+    if keystream == 'bbs':
+        return (as_buffer(data) ^ bbs_keystream(key, nonce, offset + len(data))[offset:]).tobytes()
+    if len(data) < CTR_PARALLEL_THRESHOLD or workers == 1:
+        return ctr_xor((key, nonce, offset, data))
+    jobs = [(key, nonce, (offset + i), bytes(data[i:(i + CTR_CHUNK)])) for i in range(0, len(data), CTR_CHUNK)]
+    with ProcessPoolExecutor(workers) as executor:
+        return b"".join(executor.map(ctr_xor, jobs))
+
+def encrypt_ctr(data, key, nonce=None, keystream='sdes', workers=None):
+    """
+    Encrypt data in counter mode, a random nonce is prepended to the ciphertext.
+    keystream is 'sdes' (counter blocks, parallel for large data) or 'bbs'.
+    """
+    nonce = int.from_bytes(os.urandom(NONCE_SIZE), 'big') if nonce is None else nonce
+    return nonce.to_bytes(NONCE_SIZE, 'big') + ctr_transform(data, key, nonce, keystream, 0, workers)
+
+def decrypt_ctr(data, key, keystream='sdes', workers=None):
+    """
+    Decrypt data from encrypt_ctr, the nonce is read from the front.
+    """
+    data = memoryview(data).cast('B')
+    nonce = int.from_bytes(data[:NONCE_SIZE], 'big')
+    return ctr_transform(data[NONCE_SIZE:], key, nonce, keystream, 0, workers)
@@ -0,0 +1,110 @@
+#
+# Server side connection sessions and registry
+#
+
+from collections import deque
+from protocol import FrameParser
+
+STATE_HANDSHAKE = 1 # Waiting for the nick and public key of the client.
+STATE_READY = 2 # Registered, may send and receive messages.
+STATE_PEER = 3 # Bus connection to another worker process.
+
+class Session:
+    """
+    State for a single client connection.
+    """
+    __slots__ = ('sock', 'fd', 'state', 'worker', 'deadline', 'nick', 'key', 'nonce', 'rooms', 'parser', 'out', 'queued', 'dropped', 'bytes_in', 'bytes_out', 'messages_in', 'messages_out')
+
+    def __init__(self, sock, deadline=None):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.state = STATE_HANDSHAKE
+        self.worker = None # Worker id, for bus connections.
+        self.deadline = deadline
+        self.nick = None
+        self.key = None
+        self.nonce = None # Sent with the parameters, a resume proves the key over it.
+        self.rooms = set() # Names of the rooms joined.
+        self.parser = FrameParser() # Receive buffer and incremental frame parser.
+        self.out = deque() # Outbound buffers, shared between recipients of a broadcast.
+        self.queued = 0 # Bytes waiting in out.
+        self.dropped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_in = 0
+        self.messages_out = 0
+
+    def __lt__(self, other): # Tie breaker when stored in a heap.
+        return self.fd < other.fd
+
+class Registry:
+    """
+    Active sessions keyed by file descriptor, and registered sessions keyed by nick.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.nicks = {}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __iter__(self):
+        return iter(list(self.sessions.values()))
+
+    def __contains__(self, session):
+        return self.sessions.get(session.fd) is session
+
+    def add(self, session):
+        self.sessions[session.fd] = session
+
+    def register(self, session, nick, key):
+        """
+        Link nick and public key to the session, False if the nick is taken.
+        """
+        if nick in self.nicks:
+            return False
+        session.nick, session.key = nick, key
+        session.state = STATE_READY
+        self.nicks[nick] = session
+        return True
+
+    def remove(self, session):
+        """
+        Forget the session, return True if it had registered a nick.
+        """
+        if self.sessions.get(session.fd) is session:
+            del self.sessions[session.fd]
+        if session.nick is not None and self.nicks.get(session.nick) is session:
+            del self.nicks[session.nick]
+            return True
+        return False
+
+    def find(self, nick):
+        return self.nicks.get(nick)
+
+    def users(self):
+        """
+        All registered sessions.
+        """
+        return self.nicks.values()
+
+class Room:
+    """
+    Members of a chat room. Every join is stamped by the worker it happened on, members are
+    ordered by stamp, so every worker sends the same order and clients agree on the owner, the first one.
+    Members on other workers are linked to the bus session of their worker.
+    """
+    __slots__ = ('name', 'members', 'stamps')
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {} # nick -> session.
+        self.stamps = {} # nick -> join stamp, nanoseconds.
+
+    def __len__(self):
+        return len(self.members)
+
+    def order(self):
+        return sorted(self.members, key=lambda nick: (self.stamps[nick], nick))
+
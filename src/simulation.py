@@ -4,8 +4,12 @@
 
 from bbs import blum_blum_shub, test_csprng
 from dh import generate_dh_parameters, get_private_key, get_public_key, get_shared_key
-from sdes import encrypt_sdes, decrypt_sdes
+from ciphers import SUITES, choose
+from protocol import cipher_id, CIPHER_PREFERENCE, CIPHER_SDES
+from sdes import encrypt_ctr, decrypt_ctr
+from utils import get_bytes_as_bits
 import re
+import sys
 import time
 
 def preprocess_file(txt):
@@ -13,6 +17,19 @@ def preprocess_file(txt):
     txt = txt.replace('\r', '').replace('\t', ' ').replace('\n', ' ') # Remove symbols, msg is a single line.
     return re.sub('\s\s+', ' ', txt) # Remove consecutive whitespace.
 
+def encrypt(suite, key, secret, data):
+    """
+    S-DES runs in counter mode, large files are encrypted in parallel. Other suites encrypt directly.
+    """
+    if suite.id == CIPHER_SDES:
+        return encrypt_ctr(data, secret)
+    return suite.encrypt(key, data)
+
+def decrypt(suite, key, secret, data):
+    if suite.id == CIPHER_SDES:
+        return decrypt_ctr(data, secret)
+    return suite.decrypt(key, data)
+
 def fetch_file(file):
     file = file.replace('\\', '/')
     try:
@@ -36,12 +53,15 @@ if __name__ == "__main__":
     assert SHARED_KEY_1 == SHARED_KEY_2
 
     SECRET_KEY = blum_blum_shub(10, SHARED_KEY_1) # Passed previous assert = key 1 and key 2 is equivalent.
+    SUITE = SUITES[cipher_id(sys.argv[1]) if len(sys.argv) > 1 else choose(CIPHER_PREFERENCE, SUITES)] # Named on the command line, or the one a server would pick.
+    CIPHER_KEY = SUITE.derive(SHARED_KEY_1)
 
     print('\nDiffie-Hellman Key Exchange Info: q={}, a={}. Generated random 11-bit to 16-bit primes.'.format(q,a))
     print('Alice\'s private key {}, public key {}.'.format(A_KEY_PRIV, A_KEY_PUB))
     print('Bob\'s private key {}, public key {}.'.format(B_KEY_PRIV, B_KEY_PUB))
     print('Shared Key, {}={}.'.format(SHARED_KEY_1, SHARED_KEY_2))
     print('Secret Encr/Decr Key, 10-bit for S-DES,', SECRET_KEY)
+    print('Cipher suite, {} with a {}-bit key.'.format(SUITE.name, SUITE.key_bits))
     print('')
 
     print("Sending public key from Alice to Bob")
@@ -56,18 +76,18 @@ if __name__ == "__main__":
     message_to_alice = fetch_file(input('Select file path or text to send from Bob: '))
     print('')
     
-    message_to_bob_encr = encrypt_sdes(message_to_bob, SECRET_KEY)
-    message_to_alice_encr = encrypt_sdes(message_to_alice, SECRET_KEY)
+    message_to_bob_encr = encrypt(SUITE, CIPHER_KEY, SECRET_KEY, message_to_bob.encode('utf-8'))
+    message_to_alice_encr = encrypt(SUITE, CIPHER_KEY, SECRET_KEY, message_to_alice.encode('utf-8'))
 
-    print('Alice is sending to Bob:', message_to_bob, '\nEncrypted:', message_to_bob_encr)
+    print('Alice is sending to Bob:', message_to_bob, '\nEncrypted:', get_bytes_as_bits(message_to_bob_encr))
     time.sleep(0.2)
-    print('Bob received message from Alice, decrypt with secret key:\n{}'.format(decrypt_sdes(message_to_bob_encr, SECRET_KEY)))
+    print('Bob received message from Alice, decrypt with secret key:\n{}'.format(decrypt(SUITE, CIPHER_KEY, SECRET_KEY, message_to_bob_encr).decode('utf-8')))
     time.sleep(0.1)
 
     print('')
-    print('Bob is sending to Alice:', message_to_alice, '\nEncrypted:', message_to_alice_encr)
+    print('Bob is sending to Alice:', message_to_alice, '\nEncrypted:', get_bytes_as_bits(message_to_alice_encr))
     time.sleep(0.2)
-    print('Alice received message from Bob, decrypt with secret key:\n{}'.format(decrypt_sdes(message_to_alice_encr, SECRET_KEY)))
+    print('Alice received message from Bob, decrypt with secret key:\n{}'.format(decrypt(SUITE, CIPHER_KEY, SECRET_KEY, message_to_alice_encr).decode('utf-8')))
     time.sleep(0.1)
 
     print('\nCommunication Terminated...')
@@ -0,0 +1,58 @@
+#
+# Session resumption tickets
+#
+# A ticket is opaque to the client: expiry (uint64, unix time), nick length (uint8), nick, public key and cipher suites,
+# and an HMAC-SHA256 over all of it. Any server process with the same secret can verify it.
+# The ticket travels in clear, so a resuming client also proves it holds the private key the ticket is bound to.
+#
+
+import os
+import hmac
+import time
+import struct
+import hashlib
+
+TICKET = struct.Struct('!QB')
+TICKET_TTL = 300 # Seconds a ticket can be used to resume.
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+def get_ticket_secret():
+    """
+    Key for the ticket HMAC, from SECURECHAT_TICKET_SECRET (hex) so tickets survive restarts, random otherwise.
+    """
+    secret = os.environ.get('SECURECHAT_TICKET_SECRET')
+    return bytes.fromhex(secret) if secret else os.urandom(32)
+
+def issue_ticket(secret, nick, key, ttl=TICKET_TTL):
+    """
+    Ticket binding nick to its "key:suites" until ttl seconds from now.
+    """
+    nick = nick.encode('utf-8')
+    body = TICKET.pack(int(time.time() + ttl), len(nick)) + nick + str(key).encode('ascii')
+    return body + hmac.new(secret, body, hashlib.sha256).digest()
+
+def resume_proof(shared, nonce, ticket):
+    """
+    HMAC over the nonce of the connection and the ticket, keyed by the Diffie-Hellman key the client shares
+    with the server. Only the holder of the private key can make it, and it is void on any other connection.
+    """
+    key = hashlib.sha256(b"resume" + shared.to_bytes(max(1, (shared.bit_length() + 7) // 8), 'big')).digest()
+    return hmac.new(key, nonce + ticket, hashlib.sha256).digest()
+
+def verify_ticket(secret, ticket):
+    """
+    Return (nick, key) of a valid, unexpired ticket, None otherwise.
+    """
+    if len(ticket) < (TICKET.size + DIGEST_SIZE):
+        return None
+    body, digest = ticket[:-DIGEST_SIZE], ticket[-DIGEST_SIZE:]
+    if not hmac.compare_digest(hmac.new(secret, body, hashlib.sha256).digest(), digest):
+        return None
+    expiry, length = TICKET.unpack_from(body)
+    if expiry < time.time():
+        return None
+    try:
+        nick, key = body[TICKET.size:(TICKET.size + length)].decode('utf-8'), body[(TICKET.size + length):].decode('ascii')
+    except UnicodeDecodeError:
+        return None
+    return (nick, key) if key.partition(':')[0].isdigit() else None
@@ -0,0 +1,191 @@
+#
+# Chunked, encrypted file transfer between clients
+#
+# The sender offers a file and waits until the receiver accepts it, an acknowledgement of 0 bytes.
+# Then it streams counter mode encrypted chunks straight from a memory-mapped file. The receiver
+# writes every chunk to disk as it arrives and acknowledges what it has, the sender keeps at most
+# WINDOW bytes unacknowledged.
+#
+
+import os
+import mmap
+import time
+import struct
+import threading
+from sdes import ctr_transform
+from protocol import encode, COMMAND_FILE_OFFER, COMMAND_FILE_CHUNK, COMMAND_FILE_ACK, COMMAND_FILE_CANCEL
+
+CHUNK_SIZE = 32 * 1024
+WINDOW = 4 * CHUNK_SIZE # Unacknowledged bytes in flight, kept below the server's outbound high-water mark.
+ACK_EVERY = CHUNK_SIZE # Receiver acknowledges after this many bytes.
+ACK_TIMEOUT = 30.0 # Seconds the sender waits for the window to open.
+OFFER_TIMEOUT = 120.0 # Seconds the sender waits for the receiver to accept.
+PROGRESS_STEP = 10 # Report progress every PROGRESS_STEP percent.
+
+OFFER = struct.Struct('!IQQ') # transfer id, file size, nonce. Followed by the file name.
+CHUNK = struct.Struct('!IQ') # transfer id, offset. Followed by the ciphertext.
+ACK = struct.Struct('!IQ') # transfer id, bytes received.
+
+def file_chunks(path, chunk_size=CHUNK_SIZE):
+    """
+    Yield (offset, memoryview) for every chunk of the file, without reading it into memory.
+    A chunk is only valid until the next one is requested.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            with memoryview(m) as view:
+                for offset in range(0, size, chunk_size):
+                    chunk = view[offset:(offset + chunk_size)]
+                    try:
+                        yield offset, chunk
+                    finally: # Also when the consumer stops early, the map can not close while a chunk is exported.
+                        chunk.release()
+
+def parse_offer(payload):
+    """
+    Split an offer into (transfer id, size, nonce, name), the name without any directory part.
+    """
+    if len(payload) < OFFER.size:
+        raise ValueError("Short file offer")
+    transfer_id, size, nonce = OFFER.unpack_from(payload)
+    return transfer_id, size, nonce, os.path.basename(payload[OFFER.size:].decode('utf-8', 'replace')) or "file"
+
+def rate(size, seconds):
+    return "{:.2f} MB/s".format((size / (1024 * 1024)) / max(seconds, 1e-6))
+
+class OutgoingTransfer:
+    """
+    Sends one file to a peer, encrypted under key with a fresh nonce.
+    """
+
+    def __init__(self, transfer_id, recipient, path, key, report=print):
+        self.id = transfer_id
+        self.recipient = recipient
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.key = key
+        self.nonce = int.from_bytes(os.urandom(8), 'big')
+        self.acked = 0
+        self.accepted = False
+        self.cancelled = False
+        self.cond = threading.Condition()
+        self.report = report
+
+    def offer(self):
+        return encode(COMMAND_FILE_OFFER, OFFER.pack(self.id, self.size, self.nonce) + self.name.encode('utf-8'), recipient=self.recipient)
+
+    def frames(self):
+        """
+        Generate the encrypted chunk frames, blocks until the receiver accepts and while the window is full.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.cancelled or self.accepted, OFFER_TIMEOUT):
+                self.cancelled = True
+                yield encode(COMMAND_FILE_CANCEL, ACK.pack(self.id, 0), recipient=self.recipient)
+            if self.cancelled:
+                self.report("{} did not accept {}.".format(self.recipient.capitalize(), self.name))
+                return
+        start, step = time.monotonic(), PROGRESS_STEP
+        for offset, chunk in file_chunks(self.path):
+            with self.cond:
+                if not self.cond.wait_for(lambda: self.cancelled or (offset - self.acked) < WINDOW, ACK_TIMEOUT):
+                    self.cancelled = True
+                    yield encode(COMMAND_FILE_CANCEL, ACK.pack(self.id, self.acked), recipient=self.recipient)
+                if self.cancelled:
+                    self.report("Transfer of {} to {} cancelled.".format(self.name, self.recipient.capitalize()))
+                    return
+            header = CHUNK.pack(self.id, offset)
+            yield encode(COMMAND_FILE_CHUNK, header + ctr_transform(chunk, self.key, self.nonce, offset=offset), recipient=self.recipient)
+            done = (100 * (offset + len(chunk))) // self.size
+            if done >= step:
+                self.report("Sending {} to {}: {}% ({}).".format(self.name, self.recipient.capitalize(), done, rate(offset + len(chunk), time.monotonic() - start)))
+                step = (done // PROGRESS_STEP + 1) * PROGRESS_STEP
+        with self.cond:
+            self.cond.wait_for(lambda: self.cancelled or self.acked >= self.size, ACK_TIMEOUT)
+        if self.acked >= self.size:
+            self.report("Sent {} to {}, {} bytes ({}).".format(self.name, self.recipient.capitalize(), self.size, rate(self.size, time.monotonic() - start)))
+
+    def on_ack(self, received):
+        with self.cond:
+            self.acked = max(self.acked, received)
+            self.accepted = True
+            self.cond.notify_all()
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+
+class IncomingTransfer:
+    """
+    Receives one file from a peer, chunks are decrypted and written as they arrive.
+    OSError if the file can not be created.
+    """
+
+    def __init__(self, sender, payload, key, directory='.', report=print):
+        self.id, self.size, self.nonce, self.name = parse_offer(payload)
+        self.sender = sender
+        self.path = self.unique_path(os.path.join(directory, self.name))
+        self.key = key
+        self.file = open(self.path, 'wb')
+        self.received = 0
+        self.unacked = 0
+        self.start = time.monotonic()
+        self.report = report
+        self.report("Receiving {} from {}, {} bytes -> {}.".format(self.name, sender.capitalize(), self.size, self.path))
+        if self.size == 0:
+            self.close()
+
+    @staticmethod
+    def unique_path(path):
+        base, ext = os.path.splitext(path)
+        i = 1
+        while os.path.exists(path):
+            path = "{}.{}{}".format(base, i, ext)
+            i += 1
+        return path
+
+    def on_chunk(self, payload):
+        """
+        Store a chunk, return the frame to send back (ack or cancel) or None.
+        """
+        if len(payload) < CHUNK.size:
+            self.close()
+            return encode(COMMAND_FILE_CANCEL, ACK.pack(self.id, self.received), recipient=self.sender)
+        transfer_id, offset = CHUNK.unpack_from(payload)
+        data = memoryview(payload)[CHUNK.size:]
+        if offset != self.received or (offset + len(data)) > self.size: # Lost or out of order, give up.
+            self.close()
+            return encode(COMMAND_FILE_CANCEL, ACK.pack(self.id, self.received), recipient=self.sender)
+        try:
+            self.file.write(ctr_transform(data, self.key, self.nonce, offset=offset))
+            if (self.received + len(data)) >= self.size:
+                self.file.close() # Flushes, a full disk may only show here.
+        except OSError as e: # Disk full, give up.
+            self.report("Can not store {} from {}: {}".format(self.name, self.sender.capitalize(), e))
+            self.close()
+            return encode(COMMAND_FILE_CANCEL, ACK.pack(self.id, self.received), recipient=self.sender)
+        self.received += len(data)
+        self.unacked += len(data)
+        if self.unacked < ACK_EVERY and self.received < self.size:
+            return None
+        self.unacked = 0
+        if self.received >= self.size:
+            self.close()
+            self.report("Received {} from {}, {} bytes ({}).".format(self.name, self.sender.capitalize(), self.size, rate(self.size, time.monotonic() - self.start)))
+        return encode(COMMAND_FILE_ACK, ACK.pack(self.id, self.received), recipient=self.sender)
+
+    def close(self):
+        if not self.file.closed:
+            try:
+                self.file.close()
+            except OSError: # Given up on the file already.
+                pass
+
+    @property
+    def done(self):
+        return self.file.closed
@@ -13,4 +13,9 @@ def get_as_bits(txt):
 
 def get_as_text(bits):
     return "".join([chr(int(bits[i:(i+8)],2)) for i in range(0, len(bits), 8)])
-    
\ No newline at end of file
+    
+def get_bytes_as_bits(data):
+    """
+    Render raw bytes as a bitstring, for debugging/logging only.
+    """
+    return "".join([format(v, '08b') for v in bytes(data)])
@@ -0,0 +1,8 @@
+#
+# The modules in src import each other by name, as they do when run as scripts
+#
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
@@ -0,0 +1,109 @@
+#
+# Frame encoding and the incremental frame parser
+#
+
+import socket
+import pytest
+from protocol import encode, encode_into, parse_suites, format_suites, cipher_id, FrameParser, ProtocolError, Frame
+from protocol import HEADER, MAX_FRAME, BUFFER, COMMAND_MESSAGE, COMMAND_ROSTER, COMMAND_HELLO, CIPHER_SDES, CIPHER_SHAKE
+
+def frames(parser):
+    return list(parser)
+
+def test_round_trip():
+    parser = FrameParser()
+    parser.feed(encode(COMMAND_MESSAGE, b"\x01\x02", "alice", "bob"))
+    assert frames(parser) == [Frame(COMMAND_MESSAGE, "alice", "bob", b"\x01\x02")]
+
+def test_text_payload_and_utf8_nicks():
+    parser = FrameParser()
+    parser.feed(encode(COMMAND_HELLO, "123;1+3", "zoë"))
+    assert frames(parser) == [Frame(COMMAND_HELLO, "zoë", "", b"123;1+3")]
+
+def test_nick_too_long():
+    with pytest.raises(ProtocolError):
+        encode(COMMAND_MESSAGE, b"", "x" * 256)
+
+def test_split_frame():
+    data = encode(COMMAND_MESSAGE, b"hello", "alice", "bob")
+    parser = FrameParser()
+    for i in range(len(data) - 1): # One byte at a time, nothing until the last one.
+        parser.feed(data[i:(i + 1)])
+        assert parser.next_frame() is None
+    parser.feed(data[-1:])
+    assert frames(parser) == [Frame(COMMAND_MESSAGE, "alice", "bob", b"hello")]
+    assert parser.start == parser.end == 0
+
+def test_coalesced_frames():
+    sent = [Frame(COMMAND_MESSAGE, "a", "b", bytes([i]) * i) for i in range(10)]
+    data = b"".join(encode(f.type, f.payload, f.sender, f.recipient) for f in sent)
+    parser = FrameParser()
+    parser.feed(data + data[:5]) # Ten whole frames and the start of the next.
+    assert frames(parser) == sent
+    assert parser.next_frame() is None
+    parser.feed(data[5:])
+    assert frames(parser) == sent
+
+def test_empty_frame():
+    parser = FrameParser()
+    parser.feed(encode(COMMAND_ROSTER))
+    assert frames(parser) == [Frame(COMMAND_ROSTER, "", "", b"")]
+
+def test_bad_headers():
+    parser = FrameParser()
+    parser.feed(HEADER.pack(MAX_FRAME + 1, COMMAND_MESSAGE, 0, 0))
+    with pytest.raises(ProtocolError):
+        parser.next_frame()
+    parser = FrameParser()
+    parser.feed(HEADER.pack(3, COMMAND_MESSAGE, 2, 2) + b"abcd") # Nicks longer than the body.
+    with pytest.raises(ProtocolError):
+        parser.next_frame()
+
+def test_bad_utf8_nick():
+    parser = FrameParser()
+    parser.feed(HEADER.pack(2, COMMAND_MESSAGE, 2, 0) + b"\xff\xfe")
+    with pytest.raises(UnicodeDecodeError):
+        parser.next_frame()
+
+def test_buffer_grows_for_large_frames():
+    payload = bytes(range(256)) * ((4 * BUFFER) // 256)
+    parser = FrameParser()
+    parser.feed(encode(COMMAND_MESSAGE, b"x", "a", "b"))
+    parser.feed(encode(COMMAND_MESSAGE, payload, "a", "b"))
+    assert len(parser.buffer) > BUFFER
+    assert [f.payload for f in frames(parser)] == [b"x", payload]
+
+def test_pending_data_moves_to_the_front():
+    first, second = encode(COMMAND_MESSAGE, b"1" * 100), encode(COMMAND_MESSAGE, b"2" * (BUFFER - 50))
+    parser = FrameParser()
+    parser.feed(first + second[:10])
+    assert parser.next_frame().payload == b"1" * 100
+    assert parser.start > 0
+    parser.feed(second[10:]) # Does not fit behind the pending bytes, they move to the front instead.
+    assert parser.start == 0 and len(parser.buffer) == BUFFER
+    assert parser.next_frame().payload == b"2" * (BUFFER - 50)
+
+def test_recv_into():
+    a, b = socket.socketpair()
+    with a, b:
+        payload = b"y" * (3 * BUFFER)
+        a.sendall(encode(COMMAND_MESSAGE, payload, "a", "b") + encode(COMMAND_MESSAGE, b"z", "a", "b"))
+        parser, received = FrameParser(), []
+        while len(received) < 2:
+            assert parser.recv_into(b) > 0
+            received.extend(parser)
+        assert [f.payload for f in received] == [payload, b"z"]
+        a.close()
+        assert parser.recv_into(b) == 0
+
+def test_encode_into():
+    frame, payload = encode_into(COMMAND_MESSAGE, 3, "a", "bob")
+    payload[:] = b"abc"
+    assert bytes(frame) == encode(COMMAND_MESSAGE, b"abc", "a", "bob")
+
+def test_suites():
+    assert parse_suites("3+1+3+99+x+") == [CIPHER_SHAKE, CIPHER_SDES]
+    assert parse_suites(format_suites([CIPHER_SDES, CIPHER_SHAKE])) == [CIPHER_SDES, CIPHER_SHAKE]
+    assert cipher_id('shake256') == CIPHER_SHAKE
+    with pytest.raises(ValueError):
+        cipher_id('rot13')
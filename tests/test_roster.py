@@ -0,0 +1,72 @@
+#
+# Roster versions, snapshots, deltas and resume
+#
+
+import roster
+from roster import Roster, parse_roster
+from protocol import FrameParser, COMMAND_ROSTER
+
+def payloads(frames):
+    parser = FrameParser()
+    for frame in frames:
+        parser.feed(frame)
+    parsed = list(parser)
+    assert all(f.type == COMMAND_ROSTER for f in parsed)
+    return [parse_roster(f.payload) for f in parsed]
+
+def test_parse_roster():
+    epoch, version, kind, page, pages, entries = parse_roster("7,3,D;zoë:123:1+3,bob:".encode('utf-8'))
+    assert (epoch, version, kind, page, pages) == (7, 3, 'D', 0, 1)
+    assert entries == [("zoë", 123, [1, 3]), ("bob", None, None)]
+    assert parse_roster(b"7,0,S,0,1;")[5] == []
+
+def test_batched_delta():
+    r = Roster(epoch=1)
+    assert r.flush() is None
+    r.change("alice", "10:1")
+    r.change("bob", "20:1+3")
+    r.change("alice", None)
+    r.change("carol", None) # Never joined, no change.
+    assert r.version == 3 and r.timeout() is not None
+    (epoch, version, kind, _, _, entries), = payloads([r.flush()])
+    assert (epoch, version, kind) == (1, 3, 'D')
+    assert sorted(entries, key=str) == sorted([("alice", None, None), ("bob", 20, [1, 3])], key=str)
+    assert r.flush() is None and r.timeout() is None
+
+def test_snapshot_pages(monkeypatch):
+    monkeypatch.setattr(roster, 'ROSTER_PAGE', 3)
+    r = Roster(epoch=1)
+    for i in range(7):
+        r.change("user{}".format(i), "{}:1".format(i))
+    pages = payloads(r.snapshot("user0"))
+    assert [(p[3], p[4]) for p in pages] == [(0, 2), (1, 2)]
+    assert sorted(nick for p in pages for nick, _, _ in p[5]) == ["user{}".format(i) for i in range(1, 7)]
+    assert len(payloads(Roster(epoch=2).snapshot())) == 1 # Empty, still one page.
+
+def test_resume_current_version():
+    r = Roster(epoch=5)
+    r.change("alice", "10:1")
+    (epoch, version, kind, _, _, entries), = payloads(r.resume(5, r.version))
+    assert (epoch, version, kind, entries) == (5, 1, 'D', [])
+
+def test_resume_old_version():
+    r = Roster(epoch=5)
+    r.change("alice", "10:1")
+    known = r.version
+    r.change("bob", "20:1")
+    r.change("alice", None)
+    r.change("me", "30:1")
+    (_, version, kind, _, _, entries), = payloads(r.resume(5, known, "me"))
+    assert (version, kind) == (4, 'D')
+    assert sorted(entries, key=str) == sorted([("bob", 20, [1]), ("alice", None, None)], key=str)
+
+def test_resume_falls_back_to_a_snapshot(monkeypatch):
+    monkeypatch.setattr(roster, 'ROSTER_LOG', 2)
+    r = Roster(epoch=5)
+    for i in range(4):
+        r.change("user{}".format(i), "{}:1".format(i))
+    for epoch, version in ((5, 1), (6, 4), (5, 99), (5, -1)): # Out of the log, another process, unknown versions.
+        pages = payloads(r.resume(epoch, version))
+        assert [p[2] for p in pages] == ['S']
+        assert sorted(nick for nick, _, _ in pages[0][5]) == ["user0", "user1", "user2", "user3"]
+    assert payloads(r.resume(5, 2))[0][2] == 'D' # Changes 3 and 4 are still in the log.
@@ -0,0 +1,33 @@
+#
+# Resumption tickets and resume proofs
+#
+
+import os
+from tickets import issue_ticket, verify_ticket, resume_proof, DIGEST_SIZE
+
+SECRET = os.urandom(32)
+
+def test_round_trip():
+    assert verify_ticket(SECRET, issue_ticket(SECRET, "zoë", "12345:2+3")) == ("zoë", "12345:2+3")
+
+def test_expired():
+    assert verify_ticket(SECRET, issue_ticket(SECRET, "alice", "123:1", ttl=-1)) is None
+
+def test_tampered():
+    ticket = issue_ticket(SECRET, "alice", "123:1")
+    for i in range(len(ticket)):
+        forged = bytearray(ticket)
+        forged[i] ^= 0x01
+        assert verify_ticket(SECRET, bytes(forged)) is None
+    assert verify_ticket(SECRET, ticket[:-1]) is None
+    assert verify_ticket(SECRET, ticket[:DIGEST_SIZE]) is None
+    assert verify_ticket(os.urandom(32), ticket) is None
+
+def test_resume_proof():
+    ticket = issue_ticket(SECRET, "alice", "123:1")
+    nonce = os.urandom(16)
+    proof = resume_proof(98765, nonce, ticket)
+    assert len(proof) == DIGEST_SIZE
+    assert proof == resume_proof(98765, nonce, ticket)
+    assert proof != resume_proof(98766, nonce, ticket) # Another private key.
+    assert proof != resume_proof(98765, os.urandom(16), ticket) # Another connection.